@@ -0,0 +1,90 @@
+# Where the rainbow balls are round the robot, so it can turn straight to
+# the next one instead of spinning until it shows up
+import logging
+import time
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+def wrap(angle):
+    """An angle in degrees, in -180 to 180"""
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+class ArenaMap(object):
+    """Bearing and apparent size of each ball colour seen.
+
+    There's no compass, so the heading is dead reckoned from the turn
+    commands: turn() is called with every one sent to the drive, and
+    the heading advances by the last one at TURN_RATE degrees a second
+    for full turn. Positive turns and bearings are towards the left of
+    the image, the way the stream processor steers.
+
+    A ball's bearing is the heading plus its offset from the middle of
+    the image across FIELD_OF_VIEW. Sizes are a share of the frame's
+    area, so they don't depend on the resolution the governor picks.
+    The map is `mapped` once the robot has turned through a full circle
+    since start()."""
+
+    TURN_RATE = 180.0  # degrees a second at full turn, calibrate on the floor
+    FIELD_OF_VIEW = 62.2  # degrees, horizontal, camera module v2
+
+    def __init__(self):
+        self.heading = 0.0
+        self.swept = 0.0
+        self.balls = {}
+        self._turn = 0.0
+        self._time = time.time()
+
+    @property
+    def mapped(self):
+        return self.swept >= 360.0
+
+    @property
+    def turning(self):
+        """Whether the last turn command was to turn"""
+        return self._turn != 0
+
+    def start(self):
+        """Start a fresh sweep from the current heading"""
+        self.update()
+        self.swept = 0.0
+        self.balls = {}
+
+    def update(self, now=None):
+        """Advance the heading to now by the last turn command"""
+        now = time.time() if now is None else now
+        turned = self._turn * self.TURN_RATE * (now - self._time)
+        self.heading = wrap(self.heading + turned)
+        was_mapped = self.mapped
+        self.swept += abs(turned)
+        self._time = now
+        if self.mapped and not was_mapped:
+            logger.info('arena mapped: %s', self.describe())
+
+    def turn(self, turn, now=None):
+        """A turn command has just been sent to the drive"""
+        self.update(now)
+        self._turn = turn
+
+    def see(self, colour, offset, size):
+        """A ball was seen `offset` of the image width left of the
+        middle, filling `size` of the frame"""
+        bearing = wrap(self.heading + offset * self.FIELD_OF_VIEW)
+        self.balls[colour] = (bearing, size)
+
+    def forget(self, colour):
+        self.balls.pop(colour, None)
+
+    def bearing(self, colour):
+        """How far left the ball is from the current heading in degrees,
+        or None if it hasn't been seen"""
+        if colour not in self.balls:
+            return None
+        return wrap(self.balls[colour][0] - self.heading)
+
+    def describe(self):
+        return ', '.join(
+            '%s at %.0f' % (colour, bearing)
+            for colour, (bearing, size) in sorted(self.balls.items())
+        )
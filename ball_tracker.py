@@ -0,0 +1,134 @@
+# Follows a ball from frame to frame with a Kalman filter, so only the
+# part of the image it can have moved to needs searching and the steering
+# error is smoothed rather than taken straight from a noisy centroid
+import logging
+
+import cv2
+import numpy
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class BallTracker(object):
+    """Constant velocity Kalman filter on a ball's position in the image.
+
+    Call predict() once a frame, before searching: it returns the
+    rectangle the ball should be in, as (x0, y0, x1, y1) image
+    coordinates, or None to search the whole image. The rectangle is
+    GATE standard deviations of the predicted position either side of
+    it, plus the ball's last size, so it grows the longer the ball goes
+    unseen. Then call found() with where the ball was, or missed().
+    After MAX_MISSES misses in a row the track is dropped and the whole
+    image is searched again.
+
+    Positions and velocities are in pixels and pixels a frame, so
+    reset() the tracker if the image size or framerate changes."""
+
+    GATE = 3.0
+    MARGIN = 4  # pixels round the ball's last size
+    MAX_MISSES = 5
+    PROCESS_NOISE = 1.0  # pixels a frame, how much the ball's velocity wanders
+    MEASUREMENT_NOISE = 2.0  # pixels, centroid noise
+    INITIAL_SPEED = 10.0  # pixels a frame, uncertainty in a new track's velocity
+
+    def __init__(self, image_size):
+        self.image_width, self.image_height = image_size
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.transitionMatrix = numpy.array([
+            [1, 0, 1, 0],
+            [0, 1, 0, 1],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ], numpy.float32)
+        self.kalman.measurementMatrix = numpy.array([
+            [1, 0, 0, 0],
+            [0, 1, 0, 0],
+        ], numpy.float32)
+        self.kalman.processNoiseCov = (
+            numpy.eye(4, dtype=numpy.float32) * self.PROCESS_NOISE ** 2
+        )
+        self.kalman.measurementNoiseCov = (
+            numpy.eye(2, dtype=numpy.float32) * self.MEASUREMENT_NOISE ** 2
+        )
+        self._measurement = numpy.zeros((2, 1), numpy.float32)
+        # a new track's covariance, made once rather than every time the
+        # ball is found again
+        self._initial_covariance = numpy.diag([
+            self.MEASUREMENT_NOISE ** 2, self.MEASUREMENT_NOISE ** 2,
+            self.INITIAL_SPEED ** 2, self.INITIAL_SPEED ** 2,
+        ]).astype(numpy.float32)
+        # the filter keeps numpy arrays it's given and updates them in
+        # place, so a new track is copied into these
+        self.kalman.statePost = numpy.zeros((4, 1), numpy.float32)
+        self.kalman.errorCovPost = numpy.zeros((4, 4), numpy.float32)
+        self.reset()
+
+    def reset(self):
+        self.tracking = False
+        self.misses = 0
+        self.size = (0, 0)
+
+    @property
+    def x(self):
+        """Filtered position"""
+        return float(self.kalman.statePost[0, 0])
+
+    @property
+    def y(self):
+        return float(self.kalman.statePost[1, 0])
+
+    def predict(self):
+        """Advance a frame and return the window to search, or None for
+        the whole image"""
+        if not self.tracking:
+            return None
+        state = self.kalman.predict()
+        covariance = self.kalman.errorCovPre
+        x, y = state[0, 0], state[1, 0]
+        half_width = (self.GATE * numpy.sqrt(covariance[0, 0]) +
+                      self.size[0] / 2.0 + self.MARGIN)
+        half_height = (self.GATE * numpy.sqrt(covariance[1, 1]) +
+                       self.size[1] / 2.0 + self.MARGIN)
+        x0 = int(max(0, x - half_width))
+        y0 = int(max(0, y - half_height))
+        x1 = int(min(self.image_width, x + half_width + 1))
+        y1 = int(min(self.image_height, y + half_height + 1))
+        if x1 <= x0 or y1 <= y0:
+            # predicted right out of the image
+            self.lose()
+            return None
+        return x0, y0, x1, y1
+
+    def found(self, x, y, width, height):
+        """The ball was at (x, y) and this size"""
+        self.size = (width, height)
+        self.misses = 0
+        if not self.tracking:
+            # the last track's velocity and covariance are still in them
+            state = self.kalman.statePost
+            state.fill(0)
+            state[0, 0] = x
+            state[1, 0] = y
+            covariance = self.kalman.errorCovPost
+            numpy.copyto(covariance, self._initial_covariance)
+            # given back in case this OpenCV handed out copies
+            self.kalman.statePost = state
+            self.kalman.errorCovPost = covariance
+            self.tracking = True
+            logger.debug('tracking ball from %d, %d', x, y)
+            return
+        self._measurement[0, 0] = x
+        self._measurement[1, 0] = y
+        self.kalman.correct(self._measurement)
+
+    def missed(self):
+        """The ball wasn't in the window"""
+        if not self.tracking:
+            return
+        self.misses += 1
+        if self.misses >= self.MAX_MISSES:
+            self.lose()
+
+    def lose(self):
+        logger.debug('lost track of ball after %d misses', self.misses)
+        self.reset()
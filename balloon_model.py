@@ -0,0 +1,99 @@
+# The opponent's balloon as a hue/saturation histogram, learned from the
+# middle of the image while calibrating and found again by back
+# projection, which fits a balloon's colours far better than one box of
+# HSV limits
+import logging
+import os
+
+import cv2
+import numpy
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class BalloonModel(object):
+    """2D hue/saturation histogram of the balloon's colours.
+
+    learn() adds the pixels of an HSV image under a mask to the counts.
+    Bins with at least THRESHOLD of the biggest bin's count are balloon,
+    and the table of them is what back_project() looks each pixel up in,
+    so classifying a pixel is one lookup and the mask comes out 0/255
+    like inRange's. Pixels darker than MIN_VALUE have unreliable hue, so
+    they aren't learned from or back projected.
+
+    The counts are saved with save() and loaded with load(), so a model
+    calibrated once is there for the next bout."""
+
+    HUE_BINS = 30
+    SATURATION_BINS = 32
+    THRESHOLD = 0.1
+    MIN_VALUE = 40
+    RANGES = [0, 180, 0, 256]
+
+    def __init__(self):
+        self.reset()
+
+    @property
+    def trained(self):
+        return self.table is not None
+
+    def reset(self):
+        self.counts = numpy.zeros(
+            (self.HUE_BINS, self.SATURATION_BINS), dtype=numpy.float32
+        )
+        self.table = None
+
+    def _bright(self, hsv, dst=None):
+        """0/255 mask of the pixels of an HSV image with a reliable hue"""
+        return cv2.inRange(
+            hsv, (0, 0, self.MIN_VALUE), (180, 255, 255), dst=dst
+        )
+
+    def learn(self, hsv, mask=None):
+        bright = self._bright(hsv)
+        if mask is not None:
+            bright = cv2.bitwise_and(bright, mask)
+        cv2.calcHist(
+            [hsv], [0, 1], bright, [self.HUE_BINS, self.SATURATION_BINS],
+            self.RANGES, hist=self.counts, accumulate=True
+        )
+        self._build_table()
+
+    def _build_table(self):
+        peak = self.counts.max()
+        if not peak:
+            self.table = None
+            return
+        table = numpy.zeros(self.counts.shape, dtype=numpy.float32)
+        table[self.counts >= self.THRESHOLD * peak] = 255
+        self.table = table
+
+    def back_project(self, hsv, dst=None, bright=None):
+        """0/255 mask of the balloon's colours in an HSV image, `bright`
+        a buffer for the mask of pixels bright enough to count"""
+        dst = cv2.calcBackProject(
+            [hsv], [0, 1], self.table, self.RANGES, 1, dst=dst
+        )
+        return cv2.bitwise_and(dst, self._bright(hsv, bright), dst=dst)
+
+    def save(self, path):
+        """Written alongside and renamed over the old model, so it's
+        never left half written"""
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            numpy.save(f, self.counts)
+        os.rename(temporary, path)
+        logger.info('saved balloon model to %s', path)
+
+    def load(self, path):
+        """Load the model saved at path, if there is one"""
+        if not os.path.exists(path):
+            return False
+        counts = numpy.load(path)
+        if counts.shape != self.counts.shape:
+            logger.warning('%s has %s bins, ignoring it', path, counts.shape)
+            return False
+        self.counts = counts.astype(numpy.float32)
+        self._build_table()
+        logger.info('loaded balloon model from %s', path)
+        return True
@@ -2,11 +2,13 @@ import logging
 import time
 
 from drivetrain import DriveTrain
+from camera_service import CameraService
 logging.config.fileConfig('logging.ini')
 logger = logging.getLogger('piradigm.' + __name__)
 
 class BaseChallenge(object):
-    def __init__(self, logger=logger, screen=None, timeout=120, name="Unamed"):
+    def __init__(self, logger=logger, screen=None, timeout=120, name="Unamed",
+                 camera_service=None):
         self.logger = logger
         self.logger.info("initialising %s" % name)
         self.screen = screen
@@ -15,6 +17,10 @@ class BaseChallenge(object):
         self.name = name
         self.killed = False
         self.drive = DriveTrain(timeout=self.timeout)
+        # use the menu's camera if there is one, else open our own
+        self.camera_service = camera_service
+        self.owns_camera_service = camera_service is None
+        self.camera = None
 
     @property
     def should_die(self):
@@ -27,6 +33,36 @@ class BaseChallenge(object):
         self.logger.info("%s challenge stopping" % self.name)
         self.killed = True
 
+    def lease_camera(self, roi, framerate, **settings):
+        """Get the camera set up for this challenge, see CameraService.lease"""
+        if self.camera_service is None:
+            self.camera_service = CameraService()
+        self.camera = self.camera_service.lease(roi, framerate, **settings)
+        return self.camera
+
+    def release_camera(self):
+        if self.camera_service is not None:
+            if self.owns_camera_service:
+                self.camera_service.close()
+            else:
+                self.camera_service.release()
+        self.camera = None
+
+    @property
+    def latency(self):
+        """Rolling latency percentiles in ms per pipeline stage, from
+        sensor exposure to motor command. Empty for challenges that
+        don't use the camera"""
+        processor = getattr(self, 'processor', None)
+        if processor is None:
+            return {}
+        return processor.latency.summary()
+
+    def log_latency(self):
+        processor = getattr(self, 'processor', None)
+        if processor is not None:
+            processor.latency.log(self.name)
+
     def run(self):
         """Base implementation of challenge run() required for threading"""
         pass
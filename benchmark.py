@@ -0,0 +1,523 @@
+""" Benchmarks for the vision code, run on recorded frames
+Usage:
+  benchmark.py pool <path> [options]
+  benchmark.py colour <path> [options]
+  benchmark.py pyramid <path> [options]
+  benchmark.py allocations <path> [options]
+  benchmark.py denoise <path> [options]
+  benchmark.py floor <path> [options]
+  benchmark.py session <path> [options]
+  benchmark.py -h | --help
+
+pool: frames per second detecting in the stream processor thread and in
+1 to --workers detection worker processes, and how that scales.
+
+colour: time to segment every rainbow.json colour with an HSV
+conversion and inRange per colour, against one ColourClassifier lookup.
+
+pyramid: frames per second finding the --colour ball as Rainbow does,
+at full resolution and searching coarse to fine from 2x and 4x
+downsampled frames, and how far the coarse to fine positions are from
+the full resolution ones.
+
+allocations: memory allocated per frame by Rainbow's StreamProcessor
+once its workspace buffers are warmed up, traced with tracemalloc, which
+needs Python 3. Fails if a frame allocates more than MAX_FRAME_ALLOCATION
+bytes at once, plus the blob stats allowances. That nothing's kept from
+frame to frame is tested by test_allocations.py.
+
+denoise: time per frame to denoise and segment the --colour ball with
+each Denoise method, and how steady what's found is from frame to frame:
+how often it's found and the mean change in its position and area.
+
+floor: time per frame to find the arena edge in a --colour floor mask as
+Pi Noon did, from the centroid of the largest blob of floor, and with a
+FloorEdge column scan, and how often the two agree that it's an edge.
+
+session: saving every frame as JPEG files with DebugCapture, and to a
+raw and a compressed session file with SessionRecorder: ms per frame the
+stream processor spends handing a frame over, frames per second the
+writer thread gets through and MB written. Fails if a session doesn't
+read back the same frames.
+
+<path> is a directory of images, a .bgr or .gray raw frame dump, a
+.session file recorded with --sessions or a video file.
+
+Options:
+  -h --help             Show this screen.
+  --workers=<n>         Most detection workers to try [default: 4].
+  --detector=<name>     aruco or colour [default: aruco].
+  --colour=<colour>     Colour from rainbow.json the colour detector
+                        and pyramid search look for [default: red].
+  --repeat=<n>          Times to go through the frames [default: 1].
+  --resolution=<WxH>    Frame size of raw frame dumps.
+  --kernel=<n>          Denoise kernel size [default: 5].
+"""
+import json
+import logging
+import logging.config
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+import cv2
+import numpy
+
+from blobs import Blobs, PyramidSearch
+from colour_lut import ColourClassifier
+from debug_capture import DebugCapture
+from denoise import Denoise
+from floor_edge import FloorEdge
+from detection_pool import ArucoDetector, ColourDetector, DetectionPool
+from frame_source import FileSource
+from frame_timing import FrameInfo
+from motion import ReplayDrive
+from session import Session, SessionRecorder
+from workspace import Workspace
+
+logging.config.fileConfig('logging.ini')
+logger = logging.getLogger('piradigm.' + __name__)
+
+# bytes a frame may allocate: numpy scalars and views, the Kalman
+# filter's arrays and the like, plus for each connected components pass
+# its stats arrays, the Blobs views of them and picking a blob, and a
+# little more for each blob. Image buffers aren't allowed: a 2x
+# downsampled mask of Rainbow's band, 8000, takes any frame but a
+# survey's over its limit, and even a 4x one, 2000, does once a blob is
+# in view
+MAX_FRAME_ALLOCATION = 2560
+MAX_LABELLING_ALLOCATION = 2048
+MAX_BLOB_ALLOCATION = 64
+
+
+def load_frames(path, resolution=None, grey=False, repeat=1):
+    """All the frames in a recording, in memory so reading them isn't
+    part of what's timed"""
+    frames = []
+    for frame in FileSource(path, resolution=resolution).frames():
+        if grey and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        elif not grey and frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        frames.append(frame)
+    return frames * repeat
+
+
+def detector_for(name, colour='red'):
+    """The detector and the parameters to call it with for each frame"""
+    if name == 'aruco':
+        return ArucoDetector(), {}
+    if name == 'colour':
+        hsv_lower, hsv_upper = json.load(open('rainbow.json'))[colour]
+        return ColourDetector(), {
+            'hsv_lower': tuple(hsv_lower), 'hsv_upper': tuple(hsv_upper)
+        }
+    raise ValueError('unknown detector %s' % name)
+
+
+def time_serial(detector, frames, params):
+    start_time = time.time()
+    for frame in frames:
+        detector(frame, **params)
+    return len(frames) / (time.time() - start_time)
+
+
+def time_pool(detector, frames, params, workers):
+    """Frames per second through a pool, waiting for a free slot rather
+    than dropping frames so every one is detected"""
+    pool = DetectionPool(detector, frames[0].shape, workers=workers)
+    try:
+        # let the workers start up before timing them
+        pool.submit(frames[0], -1, **params)
+        pool.drain()
+        start_time = time.time()
+        for sequence, frame in enumerate(frames):
+            pool.submit(frame, sequence, block=True, **params)
+        pool.drain()
+        return len(frames) / (time.time() - start_time)
+    finally:
+        pool.close()
+
+
+def benchmark_pool(frames, detector, params, max_workers):
+    serial = time_serial(detector, frames, params)
+    print('%-10s %8s %8s' % ('workers', 'fps', 'scaling'))
+    print('%-10s %8.1f %8s' % ('serial', serial, '-'))
+    single = None
+    for workers in range(1, max_workers + 1):
+        fps = time_pool(detector, frames, params, workers)
+        single = single or fps
+        print('%-10d %8.1f %7.2fx' % (workers, fps, fps / single))
+    return serial
+
+
+def time_per_frame(function, frames):
+    """Mean ms per frame"""
+    start_time = time.time()
+    for frame in frames:
+        function(frame)
+    return (time.time() - start_time) * 1000 / len(frames)
+
+
+def benchmark_colour(frames, colour_bounds):
+    def in_range(frame):
+        hsv = cv2.cvtColor(frame, cv2.COLOR_RGB2HSV)
+        return [
+            cv2.inRange(hsv, numpy.array(lower), numpy.array(upper))
+            for lower, upper in colour_bounds.values()
+        ]
+
+    classifier = ColourClassifier(colour_bounds)
+
+    def lookup(frame):
+        return classifier.masks(classifier.classify(frame))
+
+    first = dict(
+        (name, in_range(frames[0])[n])
+        for n, name in enumerate(colour_bounds)
+    )
+    masks = lookup(frames[0])
+    for name in colour_bounds:
+        agree = numpy.count_nonzero(first[name] == masks[name])
+        print('%-10s %5.1f%% of pixels classified the same' %
+              (name, 100.0 * agree / first[name].size))
+    print('%-28s %8s' % ('', 'ms/frame'))
+    print('%-28s %8.3f' % ('inRange, one colour', time_per_frame(
+        lambda frame: in_range(frame)[0], frames)))
+    print('%-28s %8.3f' % ('inRange, all colours', time_per_frame(
+        in_range, frames)))
+    print('%-28s %8.3f' % ('lookup, labels only', time_per_frame(
+        classifier.classify, frames)))
+    print('%-28s %8.3f' % ('lookup, all colour masks', time_per_frame(
+        lookup, frames)))
+
+
+def benchmark_pyramid(frames, colour_bounds, colour):
+    classifier = ColourClassifier(colour_bounds)
+
+    def segment(image, factor):
+        if factor == 1:
+            image = cv2.medianBlur(image, 5)
+        return classifier.mask(classifier.classify(image), colour)
+
+    def select(blobs):
+        return blobs.biggest(
+            blobs.box_area, min_size=3, min_aspect=0.5, max_aspect=2
+        )
+
+    search = PyramidSearch(segment, select)
+
+    def find(frame, factor):
+        blobs, index, x, y = search.search(frame, factor)
+        if index is None:
+            return None
+        return (x + blobs.box_centre_x[index], y + blobs.box_centre_y[index])
+
+    full = [find(frame, 1) for frame in frames]
+    print('%-8s %8s %8s %12s' % ('factor', 'fps', 'found', 'mean error'))
+    for factor in (1, 2, 4):
+        start_time = time.time()
+        found = [find(frame, factor) for frame in frames]
+        fps = len(frames) / (time.time() - start_time)
+        errors = [
+            numpy.hypot(a[0] - b[0], a[1] - b[1])
+            for a, b in zip(found, full) if a is not None and b is not None
+        ]
+        print('%-8d %8.1f %8d %10.2f px' % (
+            factor, fps, sum(1 for position in found if position is not None),
+            numpy.mean(errors) if errors else 0
+        ))
+
+
+class BlobCounter(object):
+    """While installed, counts the connected components passes and the
+    blobs they find, so a frame's allocation limit can allow for the
+    stats arrays each one returns"""
+
+    def __init__(self):
+        self.passes = 0
+        self.blobs = 0
+        self._original = None
+
+    def __enter__(self):
+        self._original = cv2.connectedComponentsWithStats
+        cv2.connectedComponentsWithStats = self
+        return self
+
+    def __exit__(self, *exc):
+        cv2.connectedComponentsWithStats = self._original
+
+    def __call__(self, *args, **kwargs):
+        result = self._original(*args, **kwargs)
+        self.passes += 1
+        # the background is a component too, but not a blob
+        self.blobs += result[0] - 1
+        return result
+
+    def limit(self):
+        return (MAX_FRAME_ALLOCATION +
+                MAX_LABELLING_ALLOCATION * self.passes +
+                MAX_BLOB_ALLOCATION * self.blobs)
+
+
+def benchmark_allocations(path, resolution, colour, repeat):
+    """Runs Rainbow's StreamProcessor.process_image, tracking, surveying
+    the arena and driving a ReplayDrive, on the frames of a recording
+    cropped to Rainbow's band as the camera would deliver them"""
+    try:
+        import tracemalloc
+    except ImportError:
+        print('allocations needs tracemalloc, run it with Python 3')
+        return False
+    # only this benchmark needs a challenge
+    import rainbow
+    roi = rainbow.Rainbow.ROI
+    source = FileSource(path, resolution=resolution, realtime=False)
+    roi.apply(source)
+    frames = []
+    for frame in source.cropped_frames():
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        # copied, frames from a session are views of its file
+        frames.append(frame.copy())
+    frames *= repeat
+    source.close()
+    processor = rainbow.StreamProcessor(
+        camera=source, drive=ReplayDrive(), colour=colour, roi=roi,
+        denoise=rainbow.Rainbow.DENOISE
+    )
+    # frames are handed to process_image here instead, so the thread
+    # reading them isn't traced along with it
+    processor.terminated = True
+    processor.frames.close()
+    processor.join()
+    processor.tracking = True
+    info = processor.frame_info = FrameInfo()
+
+    def process(index, frame):
+        info.reset(index)
+        processor.process_image(frame, None)
+
+    # log records are made whether or not anyone reads them, and aren't
+    # the vision code's
+    logging.disable(logging.INFO)
+    try:
+        # every buffer grows to its largest size on the first pass
+        for index, frame in enumerate(frames):
+            process(index, frame)
+        tracemalloc.start()
+        worst = None
+        failed = kept = 0
+        for index, frame in enumerate(frames):
+            with BlobCounter() as counter:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                process(index, frame)
+                current, peak = tracemalloc.get_traced_memory()
+            peak -= before
+            # not a leak on its own: the first traced frames replace what
+            # was allocated before tracing started
+            kept += current - before
+            limit = counter.limit()
+            if peak > limit:
+                failed += 1
+            if worst is None or peak - limit > worst[0] - worst[1]:
+                worst = (peak, limit, index, counter.passes, counter.blobs)
+    finally:
+        tracemalloc.stop()
+        logging.disable(logging.NOTSET)
+    peak, limit, index, passes, blobs = worst
+    print('%d frames, %d over their limit, %d bytes kept' % (
+        len(frames), failed, kept
+    ))
+    print('closest to its limit: frame %d, %d bytes with %d blobs in %d '
+          'passes, limit %d, a frame is %d' % (
+              index, peak, blobs, passes, limit, frames[0].nbytes
+          ))
+    print('ok' if not failed else 'FAILED')
+    return not failed
+
+
+def benchmark_denoise(frames, colour_bounds, colour, size):
+    classifier = ColourClassifier(colour_bounds)
+    workspace = Workspace()
+    print('%-10s %8s %8s %12s %12s' % (
+        'method', 'ms/frame', 'found', 'moved px', 'area change'
+    ))
+    for method in Denoise.METHODS:
+        denoise = Denoise(method, size)
+
+        def find(frame):
+            labels = classifier.classify(denoise.image(frame, workspace))
+            mask = denoise.mask(classifier.mask(
+                labels, colour, dst=workspace.buffer('mask', labels.shape)
+            ))
+            blobs = Blobs(
+                mask, labels=workspace.buffer('labels', labels.shape, numpy.int32)
+            )
+            index = blobs.biggest(
+                blobs.box_area, min_size=3, min_aspect=0.5, max_aspect=2
+            )
+            if index is None:
+                return None
+            return (blobs.box_centre_x[index], blobs.box_centre_y[index],
+                    blobs.box_area[index])
+
+        start_time = time.time()
+        found = [find(frame) for frame in frames]
+        ms = (time.time() - start_time) * 1000 / len(frames)
+        pairs = [
+            (a, b) for a, b in zip(found, found[1:])
+            if a is not None and b is not None
+        ]
+        moved = [numpy.hypot(b[0] - a[0], b[1] - a[1]) for a, b in pairs]
+        area_change = [abs(float(b[2]) - a[2]) / a[2] for a, b in pairs]
+        print('%-10s %8.3f %8d %12.2f %11.1f%%' % (
+            method, ms, sum(1 for ball in found if ball is not None),
+            numpy.mean(moved) if moved else 0,
+            100 * numpy.mean(area_change) if area_change else 0
+        ))
+
+
+def benchmark_floor(frames, colour_bounds, colour):
+    classifier = ColourClassifier(colour_bounds)
+    workspace = Workspace()
+    floor_edge = FloorEdge(workspace)
+    masks = [
+        classifier.mask(classifier.classify(frame), colour).copy()
+        for frame in frames
+    ]
+    # Pi Noon's thresholds as parts of its 45 row floor image: a centroid
+    # 18 rows up, or 36 rows of floor ahead
+    rows = masks[0].shape[0]
+
+    def centroid(mask):
+        blobs = Blobs(
+            mask, labels=workspace.buffer('labels', mask.shape, numpy.int32)
+        )
+        biggest = blobs.biggest(min_size=1)
+        return biggest is None or blobs.centroid_y[biggest] < rows * 0.4
+
+    def column_scan(mask):
+        floor_edge.update(mask)
+        return floor_edge.ahead() < rows * 0.8
+
+    agree = sum(1 for mask in masks if centroid(mask) == column_scan(mask))
+    print('%-28s %8s' % ('', 'ms/frame'))
+    print('%-28s %8.3f' % ('largest blob centroid', time_per_frame(
+        centroid, masks)))
+    print('%-28s %8.3f' % ('column scan', time_per_frame(
+        column_scan, masks)))
+    print('edge or not agreed on %.1f%% of frames' % (
+        100.0 * agree / len(masks)))
+
+
+def benchmark_session(frames):
+    directory = tempfile.mkdtemp()
+    writers = (
+        ('jpeg files', lambda: DebugCapture(
+            queue_size=len(frames), directory=directory
+        )),
+        ('session, raw', lambda: SessionRecorder(
+            os.path.join(directory, 'raw.session'), queue_size=len(frames)
+        )),
+        ('session, compressed', lambda: SessionRecorder(
+            os.path.join(directory, 'compressed.session'), compress=True,
+            queue_size=len(frames)
+        )),
+    )
+    passed = True
+    print('%-20s %8s %9s %8s' % ('', 'ms/frame', 'frames/s', 'MB'))
+    try:
+        for label, writer in writers:
+            capture = writer()
+            handed_over = 0
+            start_time = time.time()
+            for n, frame in enumerate(frames):
+                frame_start = time.time()
+                capture.capture('%dimg.jpg' % n, frame, record={'n': n})
+                handed_over += time.time() - frame_start
+            capture.close()
+            elapsed = time.time() - start_time
+            size = sum(
+                os.path.getsize(os.path.join(directory, name))
+                for name in os.listdir(directory)
+            )
+            print('%-20s %8.3f %9.1f %8.1f' % (
+                label, handed_over * 1000 / len(frames),
+                capture.written / elapsed, size / 1e6
+            ))
+            if isinstance(capture, SessionRecorder):
+                with Session(capture.path) as session:
+                    same = len(session) == len(frames) and all(
+                        numpy.array_equal(session.frame(n), frames[n])
+                        for n in range(len(frames))
+                    )
+                if not same:
+                    logger.error('%s read back different frames', label)
+                    passed = False
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(directory)
+    return passed
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    resolution = None
+    if arguments['--resolution']:
+        resolution = tuple(int(n) for n in arguments['--resolution'].split('x'))
+    if arguments['pool']:
+        detector, params = detector_for(
+            arguments['--detector'], arguments['--colour']
+        )
+        frames = load_frames(
+            arguments['<path>'], resolution,
+            grey=arguments['--detector'] == 'aruco',
+            repeat=int(arguments['--repeat'])
+        )
+        logger.info('%d frames of %s', len(frames), frames[0].shape)
+        benchmark_pool(frames, detector, params, int(arguments['--workers']))
+    elif arguments['colour']:
+        frames = load_frames(
+            arguments['<path>'], resolution, repeat=int(arguments['--repeat'])
+        )
+        benchmark_colour(frames, json.load(open('rainbow.json')))
+    elif arguments['pyramid']:
+        frames = load_frames(
+            arguments['<path>'], resolution, repeat=int(arguments['--repeat'])
+        )
+        benchmark_pyramid(
+            frames, json.load(open('rainbow.json')), arguments['--colour']
+        )
+    elif arguments['allocations']:
+        if not benchmark_allocations(
+            arguments['<path>'], resolution, arguments['--colour'],
+            int(arguments['--repeat'])
+        ):
+            sys.exit(1)
+    elif arguments['denoise']:
+        frames = load_frames(
+            arguments['<path>'], resolution, repeat=int(arguments['--repeat'])
+        )
+        benchmark_denoise(
+            frames, json.load(open('rainbow.json')), arguments['--colour'],
+            int(arguments['--kernel'])
+        )
+    elif arguments['floor']:
+        frames = load_frames(
+            arguments['<path>'], resolution, repeat=int(arguments['--repeat'])
+        )
+        benchmark_floor(
+            frames, json.load(open('rainbow.json')), arguments['--colour']
+        )
+    elif arguments['session']:
+        frames = load_frames(
+            arguments['<path>'], resolution, repeat=int(arguments['--repeat'])
+        )
+        if not benchmark_session(frames):
+            sys.exit(1)
@@ -0,0 +1,154 @@
+# Blob analysis on binary masks: one connected components pass gives the
+# stats of every blob as numpy arrays, and picking one is a vectorised
+# argmax, so noise blobs cost next to nothing
+import cv2
+import numpy
+
+from workspace import Workspace
+
+
+class Blobs(object):
+    """The connected blobs of white in a 0/255 mask.
+
+    Each attribute is an array with one entry per blob: bounding box
+    `x`, `y`, `width` and `height`, `area` in pixels and the centroid
+    `centroid_x`, `centroid_y`. The background isn't a blob. The label
+    image goes in `labels`, an int32 array the size of the mask, if
+    given."""
+
+    def __init__(self, mask, connectivity=8, labels=None):
+        count, self.labels, stats, centroids = cv2.connectedComponentsWithStats(
+            mask, labels=labels, connectivity=connectivity
+        )
+        self.count = count - 1
+        self.x = stats[1:, cv2.CC_STAT_LEFT]
+        self.y = stats[1:, cv2.CC_STAT_TOP]
+        self.width = stats[1:, cv2.CC_STAT_WIDTH]
+        self.height = stats[1:, cv2.CC_STAT_HEIGHT]
+        self.area = stats[1:, cv2.CC_STAT_AREA]
+        self.centroid_x = centroids[1:, 0]
+        self.centroid_y = centroids[1:, 1]
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def box_area(self):
+        return self.width * self.height
+
+    @property
+    def box_centre_x(self):
+        return self.x + self.width // 2
+
+    @property
+    def box_centre_y(self):
+        return self.y + self.height // 2
+
+    @property
+    def aspect_ratio(self):
+        """Height over width"""
+        return self.height.astype(numpy.float32) / self.width
+
+    def biggest(self, sizes=None, min_size=None, min_aspect=None,
+                max_aspect=None):
+        """Index of the blob with the largest of `sizes`, pixel area by
+        default, or None if there are none. Only blobs with a size over
+        min_size and an aspect ratio strictly between min_aspect and
+        max_aspect are considered. Ties go to the first blob"""
+        if sizes is None:
+            sizes = self.area
+        if not self.count:
+            return None
+        allowed = numpy.ones(self.count, dtype=bool)
+        if min_size is not None:
+            allowed &= sizes > min_size
+        if min_aspect is not None or max_aspect is not None:
+            aspect_ratio = self.aspect_ratio
+            if min_aspect is not None:
+                allowed &= aspect_ratio > min_aspect
+            if max_aspect is not None:
+                allowed &= aspect_ratio < max_aspect
+        if not allowed.any():
+            return None
+        return int(numpy.argmax(numpy.where(allowed, sizes, -1)))
+
+
+class PyramidSearch(object):
+    """Finds a blob coarse to fine.
+
+    At a factor of 2 or 4 the image is shrunk by that much and
+    segmented to find candidate blobs cheaply; only the CANDIDATES
+    biggest are then segmented again at full resolution, within their
+    bounding boxes plus a coarse pixel all round. At a factor of 1 the
+    whole image is segmented at full resolution, which small or distant
+    targets need.
+
+    segment(image, factor) returns a 0/255 mask of an image, which is
+    shrunk by factor. select(blobs) picks a blob at full resolution and
+    returns its index or None. `levels` are (area, factor) pairs in
+    increasing area order: choose() picks the factor of the last pair
+    whose area the last blob found was at least.
+
+    The downsampled image and the label images are kept in `workspace`
+    from one search to the next; segment() can keep its masks there too,
+    by factor, as long as the one for factor 1 isn't the one for the
+    coarse search."""
+
+    CANDIDATES = 2
+
+    def __init__(self, segment, select, levels=((0, 1),)):
+        self.segment = segment
+        self.select = select
+        self.levels = levels
+        self.factor = 1
+        self.mask = None
+        self.workspace = Workspace()
+
+    def choose(self, area):
+        """Set the factor for the next search from the pixel area of the
+        blob just found, or None if nothing was"""
+        factor = 1
+        if area is not None:
+            for min_area, level_factor in self.levels:
+                if area >= min_area:
+                    factor = level_factor
+        self.factor = factor
+
+    def search(self, image, factor=None):
+        """Returns (blobs, index, x, y): the Blobs the one selected is in,
+        its index or None, and the offset of the blobs in the image. The
+        mask searched last is left in `mask`"""
+        factor = factor or self.factor
+        workspace = self.workspace
+        height, width = image.shape[:2]
+        if factor == 1:
+            self.mask = self.segment(image, 1)
+            blobs = Blobs(
+                self.mask, labels=workspace.buffer('labels', (height, width), numpy.int32)
+            )
+            return blobs, self.select(blobs), 0, 0
+        size = (max(1, width // factor), max(1, height // factor))
+        small = cv2.resize(
+            image, size, dst=workspace.buffer('small', size[::-1] + image.shape[2:]),
+            interpolation=cv2.INTER_AREA
+        )
+        self.mask = self.segment(small, factor)
+        coarse = Blobs(
+            self.mask, labels=workspace.buffer('coarse labels', size[::-1], numpy.int32)
+        )
+        found = (coarse, None, 0, 0)
+        found_area = -1
+        for candidate in numpy.argsort(coarse.area)[::-1][:self.CANDIDATES]:
+            x0 = max(0, (coarse.x[candidate] - 1) * factor)
+            y0 = max(0, (coarse.y[candidate] - 1) * factor)
+            x1 = min(width, (coarse.x[candidate] + coarse.width[candidate] + 1) * factor)
+            y1 = min(height, (coarse.y[candidate] + coarse.height[candidate] + 1) * factor)
+            blobs = Blobs(
+                self.segment(image[y0:y1, x0:x1], 1),
+                labels=workspace.buffer('labels', (y1 - y0, x1 - x0), numpy.int32)
+            )
+            index = self.select(blobs)
+            if index is not None and blobs.area[index] > found_area:
+                found = (blobs, index, x0, y0)
+                found_area = blobs.area[index]
+        return found
@@ -0,0 +1,99 @@
+# Long lived camera shared by the challenges, so switching challenge
+# doesn't mean closing, reopening and re-settling the camera
+import logging
+import threading
+import time
+
+try:
+    import picamera
+except ImportError:
+    # off the robot, frames come from frame_source.FileSource instead
+    picamera = None
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class CameraService(object):
+    """Owns one PiCamera for the life of the menu. A challenge leases it
+    with the settings it needs and releases it when it finishes, instead
+    of opening and closing its own camera.
+
+    lease() only touches the settings that differ from the last lease,
+    since changing sensor mode, resolution or framerate restarts the
+    camera pipeline. Settings a challenge doesn't ask for go back to
+    their defaults so nothing leaks from one challenge to the next. How
+    long each lease took is logged and kept in `lease_times`.
+
+    `camera` can be an already open camera or FrameSource to share
+    instead of opening a PiCamera."""
+
+    OPEN_SETTLE_TIME = 2  # seconds for exposure and gains to settle
+    EXPOSURE_SETTLE_TIME = 0.3  # after changing exposure or white balance
+
+    def __init__(self, camera=None):
+        self.camera = camera
+        self.leased = False
+        self.lease_times = []
+        self._exposure = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Open the camera, if it isn't already. Normally done once when
+        the menu starts so the first challenge doesn't wait either"""
+        if self.camera is None:
+            start_time = time.time()
+            # frame timestamps on the same clock as camera.timestamp, see
+            # stamp_frame in img_base_class
+            self.camera = picamera.PiCamera(clock_mode='raw')
+            time.sleep(self.OPEN_SETTLE_TIME)
+            logger.info('camera opened in %.2f s', time.time() - start_time)
+            return True
+        return False
+
+    def lease(self, roi, framerate, iso=0, shutter_speed=0, awb_mode='auto',
+              awb_gains=None):
+        """Configure the camera for a challenge and hand it over. roi is
+        the challenge's RegionOfInterest; iso and shutter_speed of 0 mean
+        automatic, as they do for picamera"""
+        with self._lock:
+            if self.leased:
+                raise RuntimeError('camera is already leased')
+            self.leased = True
+        start_time = time.time()
+        try:
+            settle = self.open()
+            camera = self.camera
+            roi.apply(camera)
+            if camera.framerate != framerate:
+                camera.framerate = framerate
+            exposure = (iso, shutter_speed, awb_mode, awb_gains)
+            if exposure != self._exposure:
+                camera.iso = iso
+                camera.shutter_speed = shutter_speed
+                camera.awb_mode = awb_mode
+                if awb_gains is not None:
+                    camera.awb_gains = awb_gains
+                self._exposure = exposure
+                settle = True
+        except Exception:
+            self.leased = False
+            raise
+        if settle:
+            time.sleep(self.EXPOSURE_SETTLE_TIME)
+        lease_time = time.time() - start_time
+        self.lease_times.append(lease_time)
+        logger.info('camera leased in %.0f ms', lease_time * 1000)
+        return camera
+
+    def release(self):
+        """Hand the camera back, stopping anything left recording"""
+        if self.camera is not None and self.camera.recording:
+            self.camera.stop_recording()
+        self.leased = False
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+        self._exposure = None
+        self.leased = False
@@ -0,0 +1,92 @@
+# Colour classification by table lookup: every ball colour in rainbow.json
+# is segmented in one pass over the frame, with no per frame HSV conversion
+import logging
+
+import cv2
+import numpy
+
+from workspace import Workspace
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+def in_bounds(hsv, lower, upper):
+    """Which rows of an N x 3 HSV array are within the bounds. A lower
+    hue above the upper one wraps round through 180, for reds that
+    straddle it"""
+    hue, saturation, value = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    if lower[0] <= upper[0]:
+        in_hue = (hue >= lower[0]) & (hue <= upper[0])
+    else:
+        in_hue = (hue >= lower[0]) | (hue <= upper[0])
+    return (
+        in_hue &
+        (saturation >= lower[1]) & (saturation <= upper[1]) &
+        (value >= lower[2]) & (value <= upper[2])
+    )
+
+
+class ColourClassifier(object):
+    """Labels each pixel of a BGR frame with the colour it belongs to.
+
+    The frame is packed to 15 bit BGR555 by OpenCV, and the packed value
+    indexes a table with a label for every 15 bit colour. The table is
+    worked out once from the HSV bounds, with the same conversion
+    process_image has always used, so the bounds in rainbow.json mean
+    just what they did. Label 0 is none of them and the rest are
+    numbered in `order`, which also decides which colour a pixel gets
+    where bounds overlap.
+
+    classify() allocates nothing once its buffers are big enough, so the
+    labels it returns are only good until the next call. Build a new
+    classifier when the bounds change; it's cheap."""
+
+    ORDER = ('red', 'blue', 'yellow', 'green')
+
+    def __init__(self, colour_bounds, order=ORDER):
+        names = [name for name in order if name in colour_bounds]
+        names += sorted(name for name in colour_bounds if name not in order)
+        self.names = ['none'] + names
+        self.labels = dict((name, label) for label, name in enumerate(self.names))
+        # the colour in the middle of each 15 bit colour's range of 24
+        # bit ones, as one row of a frame
+        centres = numpy.arange(4, 256, 8)
+        blue, green, red = numpy.meshgrid(centres, centres, centres, indexing='ij')
+        colours = numpy.dstack(
+            (blue.ravel(), green.ravel(), red.ravel())
+        ).astype(numpy.uint8)
+        index = self._pack(colours)[0]
+        hsv = cv2.cvtColor(colours, cv2.COLOR_RGB2HSV)[0]
+        self.table = numpy.zeros(1 << 16, dtype=numpy.uint8)
+        # lowest priority first, so higher ones overwrite overlaps
+        for name in reversed(names):
+            lower, upper = colour_bounds[name]
+            self.table[index[in_bounds(hsv, lower, upper)]] = self.labels[name]
+        self.workspace = Workspace()
+
+    @staticmethod
+    def _pack(image, dst=None):
+        packed = cv2.cvtColor(image, cv2.COLOR_BGR2BGR555, dst=dst)
+        return packed.view(numpy.uint16)[..., 0]
+
+    def classify(self, image):
+        """Label image of a BGR frame"""
+        shape = image.shape[:2]
+        workspace = self.workspace
+        packed = self._pack(image, workspace.buffer('packed', shape + (2,)))
+        # take() copies any index that isn't intp into a new array, and
+        # buffers its output unless told how to handle bad indices
+        index = workspace.buffer('index', shape, numpy.intp)
+        numpy.copyto(index, packed)
+        labels = workspace.buffer('labels', shape)
+        numpy.take(self.table, index, out=labels, mode='clip')
+        return labels
+
+    def mask(self, labels, colour, dst=None):
+        """0/255 mask of one colour in a label image, as inRange gives"""
+        return cv2.compare(labels, self.labels[colour], cv2.CMP_EQ, dst=dst)
+
+    def masks(self, labels):
+        return dict(
+            (name, self.mask(labels, name)) for name in self.names[1:]
+        )
@@ -0,0 +1,151 @@
+# Debug images saved by a background thread, so JPEG encoding and the SD
+# card's write latency stay out of the control loop, and a card that
+# can't keep up costs dropped images rather than dropped frames
+from collections import deque
+import logging
+import os
+import threading
+
+import cv2
+import numpy
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+def capture_for(when, directory='.', sessions=None, name='session'):
+    """The DebugCapture for a --debug-images setting: 'off', 'changes' to
+    save a frame whenever the state it's saved with changes, or n to save
+    every nth frame. With a sessions directory the frames go into one
+    session file there named after `name` and the time, rather than an
+    image file each"""
+    if when is None or when == 'off':
+        return None
+    if when == 'changes':
+        options = {'every': 0, 'on_change': True}
+    else:
+        options = {'every': int(when)}
+    if sessions is not None:
+        from session import SessionRecorder, session_path
+        return SessionRecorder(session_path(sessions, name), **options)
+    return DebugCapture(directory=directory, **options)
+
+
+class DebugCapture(object):
+    """Writes images handed to it to files from a writer thread.
+
+    The stream processor calls due() once a frame with whatever state
+    it's in, e.g. whether it can see its target, and put() with the image
+    if it's due: every `every`th frame, and with on_change whenever the
+    state isn't the last frame's. That way an image only has to be
+    converted for saving when it's going to be saved.
+
+    put() copies the image, as it's usually a workspace buffer, into one
+    of the copies the writer is finished with, and queues it along with
+    the frame's record, a dict of what was decided, which subclasses
+    such as SessionRecorder save too. At most
+    queue_size images wait to be written, past that the policy says
+    which goes: 'drop oldest' keeps the queue up to date, 'drop newest'
+    keeps a run of frames unbroken. `written`, `dropped`, `failed` and
+    `skipped`, the frames that weren't due, are counted for log_stats().
+    close() writes what's queued and stops the writer."""
+
+    POLICIES = ('drop oldest', 'drop newest')
+
+    def __init__(self, queue_size=8, policy='drop oldest', every=1,
+                 on_change=False, directory='.'):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown drop policy %s' % policy)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.every = every
+        self.on_change = on_change
+        self.directory = directory
+        self.frames = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.skipped = 0
+        self._state = None
+        self._queue = deque()
+        self._spare = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def due(self, state=None):
+        """Whether this frame is to be saved, called once a frame"""
+        changed = self.on_change and (not self.frames or state != self._state)
+        self._state = state
+        self.frames += 1
+        if changed or (self.every and self.frames % self.every == 0):
+            return True
+        self.skipped += 1
+        return False
+
+    def put(self, name, image, record=None):
+        """Queue a copy of image to be saved as name. Returns False if it
+        was dropped"""
+        with self._condition:
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+                if self.policy == 'drop newest':
+                    return False
+                self._spare.append(self._queue.popleft()[1])
+            copy = self._copy_for(image)
+            numpy.copyto(copy, image)
+            self._queue.append((name, copy, record))
+            self._condition.notify()
+        return True
+
+    def capture(self, name, image, state=None, record=None):
+        """due() and put() together, for images that are ready to save"""
+        if self.due(state):
+            return self.put(name, image, record)
+        return False
+
+    def log_stats(self):
+        logger.info(
+            'debug images: %d frames, %d written, %d dropped, %d failed, '
+            '%d not due', self.frames, self.written, self.dropped,
+            self.failed, self.skipped
+        )
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+
+    def _copy_for(self, image):
+        for n, spare in enumerate(self._spare):
+            if spare.shape == image.shape and spare.dtype == image.dtype:
+                return self._spare.pop(n)
+        # the frame size has changed, the old copies won't be used again
+        self._spare = []
+        return numpy.empty_like(image)
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                name, image, record = self._queue.popleft()
+            try:
+                saved = self._save(name, image, record)
+            except (cv2.error, IOError, OSError) as e:
+                logger.error('could not save %s: %s', name, e)
+                saved = False
+            with self._condition:
+                if saved:
+                    self.written += 1
+                else:
+                    self.failed += 1
+                self._spare.append(image)
+
+    def _save(self, name, image, record):
+        """Save one image, on the writer thread"""
+        return cv2.imwrite(os.path.join(self.directory, name), image)
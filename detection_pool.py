@@ -0,0 +1,284 @@
+# Runs detection in worker processes, so thresholding and marker detection
+# use all four cores of the Pi instead of sharing one GIL with the UI, the
+# challenge loop and the stream processor
+import logging
+import multiprocessing
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import cv2
+import cv2.aruco as aruco
+import numpy
+
+from blobs import Blobs
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+def _work(detector, memory, shape, tasks, results):
+    """Worker process loop: detect in the frame in a shared memory slot
+    and send back just the result"""
+    # one core per worker, OpenCV's own threads would only compete
+    cv2.setNumThreads(1)
+    slot_size = int(numpy.prod(shape))
+    memory = numpy.ctypeslib.as_array(memory)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, sequence, frame_shape, params = task
+        start = slot * slot_size
+        frame = memory[start:start + int(numpy.prod(frame_shape))]
+        frame = frame.reshape(frame_shape)
+        try:
+            result = detector(frame, **params)
+        except Exception:
+            logger.exception('detection failed on frame %d', sequence)
+            result = None
+        results.put((slot, sequence, result))
+
+
+class DetectionPool(object):
+    """Runs `detector` on frames in `workers` processes.
+
+    submit() copies a frame into one of `slots` shared memory buffers and
+    queues it; only the detector's result, which should be small, is
+    pickled back. With every slot in flight a frame is dropped rather
+    than queued behind stale ones, unless block is set. Results can come
+    back out of order, collect() returns the newest and counts the
+    others as stale.
+
+    `shape` is the largest frame that will be submitted; smaller ones,
+    say after the governor drops the resolution, fit in the same slots.
+    `detector` is called as detector(frame, **params) and has to be
+    picklable. Create the pool before starting threads that hold locks
+    the workers might inherit."""
+
+    def __init__(self, detector, shape, workers=3, slots=None):
+        self.shape = tuple(shape)
+        self.workers = workers
+        slots = slots or workers * 2
+        self._frame_size = int(numpy.prod(self.shape))
+        self._memory = multiprocessing.RawArray('B', slots * self._frame_size)
+        memory = numpy.ctypeslib.as_array(self._memory)
+        self._slots = [
+            memory[slot * self._frame_size:(slot + 1) * self._frame_size]
+            for slot in range(slots)
+        ]
+        self._free = list(range(slots))
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._processes = []
+        for n in range(workers):
+            process = multiprocessing.Process(
+                target=_work, name='detector-%d' % n,
+                args=(detector, self._memory, self.shape, self._tasks,
+                      self._results)
+            )
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._newest = -1
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.stale = 0
+
+    @property
+    def pending(self):
+        return len(self._slots) - len(self._free)
+
+    def submit(self, frame, sequence, block=False, **params):
+        """Queue a frame for detection. Returns False if it was dropped
+        because every slot is busy; with block set, waits for one
+        instead"""
+        if frame.size > self._frame_size:
+            raise ValueError('frame of %s is bigger than the pool\'s %s' %
+                             (frame.shape, self.shape))
+        if not self._free:
+            if block:
+                self._receive(True)
+            else:
+                self.dropped += 1
+                return False
+        slot = self._free.pop()
+        numpy.copyto(
+            self._slots[slot][:frame.size].reshape(frame.shape), frame
+        )
+        self._tasks.put((slot, sequence, frame.shape, params))
+        self.submitted += 1
+        return True
+
+    def _receive(self, wait):
+        """Take one result off the queue and free its slot. Returns
+        (sequence, result), or None if wait is False and there are none"""
+        try:
+            slot, sequence, result = self._results.get(wait and self.pending > 0)
+        except queue.Empty:
+            return None
+        self._free.append(slot)
+        self.completed += 1
+        return sequence, result
+
+    def collect(self, wait=False):
+        """Gather the finished results and return the newest as
+        (sequence, result), or None if nothing newer than the last one
+        returned has finished. With wait set, waits for at least one
+        result if any are pending"""
+        newest = None
+        received = self._receive(wait)
+        while received is not None:
+            sequence = received[0]
+            if sequence > self._newest:
+                if newest is not None:
+                    self.stale += 1
+                newest = received
+                self._newest = sequence
+            else:
+                self.stale += 1
+            received = self._receive(False)
+        return newest
+
+    def reset(self):
+        """Wait for everything in flight and start again, for a pool
+        kept from one challenge to the next: sequence numbers start from
+        0 again and the counts are the new challenge's"""
+        self.drain()
+        self._newest = -1
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def drain(self):
+        """Wait for everything submitted, returning the results in
+        sequence order"""
+        results = []
+        while self.pending:
+            results.append(self._receive(True))
+        return sorted(results, key=lambda received: received[0])
+
+    def close(self):
+        # a worker with results still queued can't exit until they're read
+        self.drain()
+        for process in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    def log_stats(self):
+        logger.info(
+            'detection pool: %d workers, %d submitted, %d completed, '
+            '%d dropped, %d stale', self.workers, self.submitted,
+            self.completed, self.dropped, self.stale
+        )
+
+
+class MarkerDetection(object):
+    """Mixin for the stream processors that steer by ArUco markers. They
+    have `detector`, an ArucoDetector, and `pool`, a DetectionPool or
+    None to detect in the stream processor thread.
+
+    With a pool, results come back a frame or two late and some frames
+    have none. On those the processor calls wait_for_detection(), which
+    leaves the drive as it is for up to DETECTION_TIMEOUT seconds since
+    the last result and then stops it, so a stalled pool can't leave
+    the robot driving blind."""
+
+    DETECTION_TIMEOUT = 0.25
+    last_detection = None
+    detection_stalled = False
+
+    def detect(self, gray):
+        """Markers in the frame as (corners, ids). With a detection pool
+        the frame is queued and this is the newest result back from the
+        workers, or None if none has come back"""
+        if self.pool is None:
+            detected = self.detector(gray)
+        else:
+            self.pool.submit(gray, self.frame_info.index)
+            result = self.pool.collect()
+            detected = None if result is None else result[1]
+        if detected is not None:
+            self.last_detection = time.time()
+            self.detection_stalled = False
+        return detected
+
+    def wait_for_detection(self):
+        """Decide what the drive does on a frame detect() had nothing for"""
+        now = time.time()
+        if self.last_detection is None:
+            # nothing back yet, the timeout starts from the first frame
+            self.last_detection = now
+        if now - self.last_detection < self.DETECTION_TIMEOUT:
+            return
+        if not self.detection_stalled:
+            logger.warning(
+                'no detection results for %.2f s, stopping',
+                now - self.last_detection
+            )
+            self.detection_stalled = True
+        self.drive.move(0, 0)
+
+
+class ArucoDetector(object):
+    """Finds ArUco markers in a greyscale frame and returns (corners, ids)
+    as aruco.detectMarkers does. The detector parameters are made once
+    rather than every frame. Neither they nor the dictionary can be
+    pickled, so a worker process makes its own dictionary of `markers`
+    markers of `bits` x `bits`, which has to match `dictionary`"""
+
+    def __init__(self, dictionary=None, markers=6, bits=3):
+        self.markers = markers
+        self.bits = bits
+        self._dict = dictionary
+        self._parameters = None
+
+    def __getstate__(self):
+        return {'markers': self.markers, 'bits': self.bits}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __call__(self, gray):
+        if self._dict is None:
+            self._dict = aruco.Dictionary_create(self.markers, self.bits)
+        if self._parameters is None:
+            self._parameters = aruco.DetectorParameters_create()
+        corners, ids, rejected = aruco.detectMarkers(
+            gray, self._dict, parameters=self._parameters
+        )
+        return corners, ids
+
+
+class ColourDetector(object):
+    """Finds the biggest roughly square blob of a colour in a BGR frame,
+    the way the rainbow challenge does, and returns (x, y, area) of its
+    bounding box, or None. The bounds are passed with each frame so the
+    colour can change between frames"""
+
+    def __init__(self, min_area=3, blur=5):
+        self.min_area = min_area
+        self.blur = blur
+
+    def __call__(self, image, hsv_lower=(40, 0, 0), hsv_upper=(180, 255, 255)):
+        image = cv2.medianBlur(image, self.blur)
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        imrange = cv2.inRange(
+            image, numpy.array(hsv_lower), numpy.array(hsv_upper)
+        )
+        blobs = Blobs(imrange)
+        box_area = blobs.box_area
+        biggest = blobs.biggest(
+            box_area, min_size=self.min_area, min_aspect=0.5, max_aspect=2
+        )
+        if biggest is None:
+            return None
+        return (
+            blobs.box_centre_x[biggest], blobs.box_centre_y[biggest],
+            box_area[biggest]
+        )
@@ -0,0 +1,78 @@
+# Measurements and overlays that only matter to someone watching, kept
+# off the control path: they are worked out when a frame is published
+# to a subscriber that asks for them, and not at all otherwise
+import logging
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class Probes(object):
+    """The values published for one frame. Those given to publish() are
+    there already, the rest are worked out by their probe the first
+    time they're asked for and kept for the rest of the frame"""
+
+    def __init__(self, probes, values):
+        self._probes = probes
+        self._values = values
+
+    def __contains__(self, name):
+        return name in self._values or name in self._probes
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            self._values[name] = self._probes[name](self)
+        return self._values[name]
+
+    def names(self):
+        return sorted(set(self._values) | set(self._probes))
+
+
+class Diagnostics(object):
+    """Lazy probes on a stream processor's frames.
+
+    probe(name, function) registers a value that can be worked out from
+    the others: function is called with the Probes of the frame. The
+    stream processor calls publish() once a frame with what it worked
+    out anyway, and that does nothing unless a debug view or recorder
+    has subscribed. Subscribers are called with the Probes on the
+    stream processor's thread, so should be quick about it."""
+
+    def __init__(self):
+        self._probes = {}
+        self._subscribers = ()
+
+    @property
+    def active(self):
+        return bool(self._subscribers)
+
+    def probe(self, name, function):
+        self._probes[name] = function
+
+    def subscribe(self, subscriber):
+        # replaced rather than changed, so publish() never sees it change
+        self._subscribers = self._subscribers + (subscriber,)
+
+    def unsubscribe(self, subscriber):
+        self._subscribers = tuple(
+            other for other in self._subscribers if other != subscriber
+        )
+
+    def publish(self, **values):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        probes = Probes(self._probes, values)
+        for subscriber in subscribers:
+            subscriber(probes)
+
+
+class DiagnosticsLog(object):
+    """Recorder that logs the named probes of every frame"""
+
+    def __init__(self, names):
+        self.names = names
+
+    def __call__(self, probes):
+        logger.debug(', '.join(
+            '%s: %s' % (name, probes[name]) for name in self.names
+        ))
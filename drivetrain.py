@@ -1,11 +1,19 @@
 # !/usr/bin/env python
 # coding: Latin-1
 
-import piconzero
 import math
 import time
 import logging
 
+from motion import MotionPrimitives
+
+try:
+    import piconzero
+except ImportError:
+    # off the robot there's no smbus, replay and the benchmarks drive a
+    # ReplayDrive instead
+    piconzero = None
+
 logging.basicConfig(
     filename='piradigm.log',
     level=logging.DEBUG,
@@ -15,8 +23,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-class DriveTrain():
+class DriveTrain(MotionPrimitives):
+    """Motors through the PiconZero. move() sets them straight away,
+    see MotionPrimitives for timed turns and pulses that don't hold up
+    the caller"""
+
     def __init__(self, timeout=120):
+        MotionPrimitives.__init__(self)
         time.sleep(0.01)
         logging.info("initialising drivetrain")
         self.timeout = timeout
@@ -45,10 +58,12 @@ class DriveTrain():
         self.killed = False
         self.left_counter = 0
         self.right_counter = 0
+        # when the last motor command went out, for latency measurement
+        self.last_move_time = 0
         # Initialise self.average_batt_v with current_batt_v
         self.average_batt_v = self.current_batt_v
 
-    def move(self, forward, turn):
+    def _set_motors(self, forward, turn):
         steering_left, steering_right = self.steering(forward, turn)
         motor_left, motor_right = self.get_motor_values(steering_left, steering_right)
         self.left_counter, motor_left = self.dither(self.left_counter, motor_left)
@@ -64,6 +79,7 @@ class DriveTrain():
                 motor_left = int(float(motor_left) * self.BATT_CONSTANTS['min_v'] / self.average_batt_v)
             self.pz.setMotor(1, motor_right)
             self.pz.setMotor(0, motor_left)
+            self.last_move_time = time.time()
         else:
             logging.info("stopping, battery too low for motors, at: %.2f", self.average_batt_v)
             self.pz.setMotor(1, 0)
@@ -117,7 +133,9 @@ class DriveTrain():
 
     def stop(self):
         logging.info("DriveTrain stopping")
-        self.pz.stop()
+        with self.motion_lock:
+            self.cancel()
+            self.pz.stop()
         self.pz.cleanup()
         self.killed = True
 
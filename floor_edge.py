@@ -0,0 +1,67 @@
+# How much floor there is ahead of the robot in each direction, from the
+# floor mask: one reduction down the columns instead of finding the floor's
+# contours, and a heading to steer for rather than only "near the edge"
+import numpy
+
+
+class FloorEdge(object):
+    """Free space profile of a 0/255 floor mask whose first row is the
+    floor nearest the robot.
+
+    update() finds, for every column, how many rows of floor there are
+    before the first row that isn't floor, all the rows if there isn't
+    one. That's `free`. The columns are then split into SECTORS headings
+    and `sectors` is the median of each, so a speck of noise a few
+    columns wide doesn't count as the edge of the arena."""
+
+    SECTORS = 8
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.free = None
+        self.sectors = None
+        self.width = 0
+        self._order = sorted(
+            range(self.SECTORS),
+            key=lambda sector: abs(sector - (self.SECTORS - 1) / 2.0)
+        )
+
+    def update(self, mask):
+        rows, columns = mask.shape[:2]
+        # an extra row that's never floor ends the scan of a column that's
+        # floor all the way, so argmax's first hit is always an edge
+        edges = self.workspace.buffer('floor edges', (rows + 1, columns))
+        numpy.equal(mask, 0, out=edges[:rows])
+        edges[rows] = 1
+        self.free = numpy.argmax(
+            edges, axis=0,
+            out=self.workspace.buffer('free space', (columns,), numpy.intp)
+        )
+        used = columns - columns % self.SECTORS
+        self.sectors = numpy.median(
+            self.free[:used].reshape(self.SECTORS, -1), axis=1
+        )
+        self.width = columns
+        return self.free
+
+    def ahead(self):
+        """Free rows straight ahead, the least of the two middle sectors"""
+        middle = self.SECTORS // 2
+        return self.sectors[middle - 1:middle + 1].min()
+
+    def clearest(self):
+        """The sector with the most floor, the nearest the middle of those
+        with as much"""
+        return max(self._order, key=lambda sector: self.sectors[sector])
+
+    def column(self, sector):
+        """Mask column in the middle of a sector"""
+        return (sector + 0.5) * self.width / self.SECTORS
+
+    def heading(self):
+        """Mask column to steer for: straight on unless there's more floor
+        in another sector"""
+        clearest = self.clearest()
+        if self.sectors[clearest] <= self.ahead():
+            return self.width / 2.0
+        return self.column(clearest)
@@ -0,0 +1,266 @@
+# Publish/subscribe camera output: frames go into shared memory once and
+# any number of consumers, in threads or processes, read them at their
+# own pace without holding up the camera or each other
+import logging
+import multiprocessing
+import threading
+import time
+
+import cv2
+import numpy
+
+from img_base_class import (
+    FrameRing, mirrored_surface, padded_frame_shape, stamp_frame
+)
+from frame_timing import FrameInfo
+from workspace import Workspace
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class FrameBus(object):
+    """Camera output that publishes frames to subscribers through shared
+    memory.
+
+    Frames are written into `slots` shared buffers. A subscriber pins
+    the newest frame while it works on it and the camera only ever
+    writes into slots nobody has pinned, so no frame changes under a
+    reader and the camera never waits for one. With at least two more
+    slots than subscribers there is always somewhere to write. A slow
+    subscriber just skips the frames that came and went while it was
+    busy, and those are counted.
+
+    Subscribe everything before forking any subscriber processes, the
+    shared memory and locks are inherited."""
+
+    def __init__(self, camera, max_subscribers=4, slots=None,
+                 format=FrameRing.BGR):
+        self.camera = camera
+        self.format = format
+        self.camera_format = 'yuv' if format == FrameRing.LUMA else 'bgr'
+        self.max_subscribers = max_subscribers
+        slots = slots or max_subscribers + 2
+        width, height = camera.resolution
+        shape = padded_frame_shape(camera.resolution, format)
+        self._frame_size = int(numpy.prod(shape))
+        self._memory = multiprocessing.RawArray('B', slots * self._frame_size)
+        memory = numpy.ctypeslib.as_array(self._memory)
+        self._flat = [
+            memory[slot * self._frame_size:(slot + 1) * self._frame_size]
+            for slot in range(slots)
+        ]
+        self._frames = [
+            flat.reshape(shape)[:height, :width] for flat in self._flat
+        ]
+        # per slot: frame sequence number and its timing
+        self._sequence = multiprocessing.RawArray('l', [-1] * slots)
+        # microseconds on the camera's raw clock outgrow 32 bits
+        self._timestamp = multiprocessing.RawArray('q', [-1] * slots)
+        self._captured = multiprocessing.RawArray('d', slots)
+        self._exposed = multiprocessing.RawArray('d', slots)
+        # per subscriber: the slot it has pinned and what it has seen
+        self._pins = multiprocessing.RawArray('l', [-1] * max_subscribers)
+        self._received = multiprocessing.RawArray('l', max_subscribers)
+        self._skipped = multiprocessing.RawArray('l', max_subscribers)
+        self._latest = multiprocessing.RawValue('l', -1)
+        self._closed = multiprocessing.RawValue('b', 0)
+        self._cond = multiprocessing.Condition()
+        self._info = FrameInfo()
+        self.subscribers = []
+        self.published = 0
+
+    @property
+    def output(self):
+        return self
+
+    def subscribe(self, name):
+        if len(self.subscribers) == self.max_subscribers:
+            raise ValueError('frame bus is limited to %d subscribers' %
+                             self.max_subscribers)
+        subscription = Subscription(self, len(self.subscribers), name)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def _claim(self):
+        """A slot that is neither pinned nor holding the newest frame"""
+        with self._cond:
+            pinned = set(self._pins)
+            for slot in range(len(self._flat)):
+                if slot != self._latest.value and slot not in pinned:
+                    return slot
+        return None
+
+    def write(self, buf):
+        """Called by the camera with one complete frame"""
+        slot = self._claim()
+        if slot is None:
+            # only if there are fewer slots than subscribers + 2
+            return len(buf)
+        flat = self._flat[slot]
+        size = min(len(buf), flat.size)
+        flat[:size] = numpy.frombuffer(buf, dtype=numpy.uint8, count=size)
+        info = self._info
+        stamp_frame(self.camera, info, self.published)
+        with self._cond:
+            self._sequence[slot] = self.published
+            self._timestamp[slot] = -1 if info.timestamp is None else info.timestamp
+            self._captured[slot] = info.captured
+            self._exposed[slot] = info.exposed
+            self._latest.value = slot
+            self._cond.notify_all()
+        self.published += 1
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Wake every subscriber up so it can exit"""
+        with self._cond:
+            self._closed.value = 1
+            self._cond.notify_all()
+
+    def log_stats(self):
+        logger.info('frames published: %d', self.published)
+        for subscription in self.subscribers:
+            logger.info(
+                '%s received: %d, skipped: %d', subscription.name,
+                subscription.received, subscription.skipped
+            )
+
+
+class Subscription(object):
+    """One consumer's view of a FrameBus. Has the same acquire/release
+    interface as FrameRing, so a stream processor can read from either"""
+
+    def __init__(self, bus, index, name):
+        self.bus = bus
+        self.index = index
+        self.name = name
+        self.current = FrameInfo()
+        self._last = -1
+
+    @property
+    def output(self):
+        return self.bus
+
+    @property
+    def received(self):
+        return self.bus._received[self.index]
+
+    @property
+    def skipped(self):
+        return self.bus._skipped[self.index]
+
+    def _has_new(self):
+        bus = self.bus
+        latest = bus._latest.value
+        return latest >= 0 and bus._sequence[latest] > self._last
+
+    def acquire(self, timeout=None):
+        """Wait for a frame newer than the last one and pin it. Returns a
+        numpy view of the frame, or None once the bus is closed or if
+        nothing arrived within timeout"""
+        bus = self.bus
+        with bus._cond:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while not bus._closed.value and not self._has_new():
+                if timeout is None:
+                    bus._cond.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        break
+                    bus._cond.wait(remaining)
+            if bus._closed.value or not self._has_new():
+                return None
+            slot = bus._latest.value
+            bus._pins[self.index] = slot
+            sequence = bus._sequence[slot]
+            timestamp = bus._timestamp[slot]
+            captured = bus._captured[slot]
+            exposed = bus._exposed[slot]
+        if self._last >= 0:
+            bus._skipped[self.index] += sequence - self._last - 1
+        bus._received[self.index] += 1
+        self._last = sequence
+        self.current.reset(
+            sequence, None if timestamp < 0 else timestamp, captured, exposed
+        )
+        self.current.handed_off = time.time()
+        return bus._frames[slot]
+
+    def release(self):
+        """Unpin the frame taken by acquire()"""
+        with self.bus._cond:
+            self.bus._pins[self.index] = -1
+
+    def close(self):
+        self.bus.close()
+
+
+class FrameSubscriber(object):
+    """Consumes frames from a FrameBus in its own thread, or its own
+    process to get it out from under the GIL. Subclasses implement
+    handle(frame, info), and can set `interval` to limit how often it
+    runs"""
+
+    def __init__(self, bus, name, process=False, interval=0):
+        self.name = name
+        self.interval = interval
+        self.subscription = bus.subscribe(name)
+        worker = multiprocessing.Process if process else threading.Thread
+        self._worker = worker(target=self.run, name=name)
+        self._worker.daemon = True
+
+    def start(self):
+        self._worker.start()
+
+    def join(self):
+        self._worker.join()
+
+    def run(self):
+        while True:
+            frame = self.subscription.acquire()
+            if frame is None:
+                break
+            try:
+                self.handle(frame, self.subscription.current)
+            finally:
+                self.subscription.release()
+            if self.interval:
+                time.sleep(self.interval)
+
+    def handle(self, frame, info):
+        pass
+
+
+class PreviewSubscriber(FrameSubscriber):
+    """Gets the camera image ready for the touchscreen off the control
+    path: converting and flipping it is done in the subscriber's thread,
+    and the thread that owns the display only has to draw() it, as
+    pygame's display can't be drawn on from two threads"""
+
+    def __init__(self, bus, position=(0, 0), interval=0.1):
+        super(PreviewSubscriber, self).__init__(
+            bus, 'preview', interval=interval
+        )
+        self.position = position
+        self.workspace = Workspace()
+        self._surface = None
+        self._lock = threading.Lock()
+
+    def handle(self, frame, info):
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(
+                frame, cv2.COLOR_BGR2RGB, dst=self.workspace.like('rgb', frame)
+            )
+        with self._lock:
+            self._surface = mirrored_surface(self.workspace, 'preview', frame)
+
+    def draw(self, screen):
+        """Blit the latest preview, if there is one yet"""
+        with self._lock:
+            if self._surface is not None:
+                screen.blit(self._surface, self.position)
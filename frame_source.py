@@ -0,0 +1,271 @@
+# Frame sources ImageCapture can record from. On the robot that is the
+# PiCamera itself; off it, FileSource replays recorded frames so the
+# stream processors can be run and profiled on any Linux box
+import abc
+import logging
+import os
+import threading
+import time
+
+import cv2
+import numpy
+
+from session import Session
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+# abc.ABC, made so that Python 2 has it too
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+def raw_resolution(resolution):
+    """Round a resolution up to the 32x16 block size the GPU pads
+    unencoded frames to"""
+    width, height = resolution
+    return ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+
+
+class SourceFrame(object):
+    """Stands in for picamera's PiVideoFrame"""
+
+    __slots__ = ('index', 'timestamp')
+
+    def __init__(self, index, timestamp):
+        self.index = index
+        self.timestamp = timestamp
+
+
+class FrameSource(_ABC):
+    """The part of the PiCamera interface ImageCapture, FrameRing,
+    RegionOfInterest and CameraService rely on. picamera.PiCamera is
+    the camera backend and provides all of it already; other backends
+    subclass this, and can't be made without a start_recording().
+
+    start_recording() must call output.write() once per frame with the
+    frame laid out as picamera does for unencoded formats: 'bgr' or
+    'yuv' (YUV420), padded to the 32x16 block size. `frame.timestamp`
+    and `timestamp` are on the source's own microsecond clock, as a
+    PiCamera's are with clock_mode 'raw'."""
+
+    def __init__(self, resolution, framerate=30):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.sensor_mode = 0
+        self.clock_mode = 'raw'
+        self.zoom = (0.0, 0.0, 1.0, 1.0)
+        self.iso = 0
+        self.shutter_speed = 0
+        self.awb_mode = 'auto'
+        self.awb_gains = None
+        self.frame = None
+        self.recording = False
+        self._start_time = time.time()
+
+    @property
+    def timestamp(self):
+        return int((time.time() - self._start_time) * 1000000)
+
+    @abc.abstractmethod
+    def start_recording(self, output, format='bgr', **options):
+        pass
+
+    def wait_recording(self, timeout=0):
+        if self.recording:
+            time.sleep(timeout)
+
+    def stop_recording(self):
+        pass
+
+    def close(self):
+        if self.recording:
+            self.stop_recording()
+
+
+class FileSource(FrameSource):
+    """Replays an image directory, a raw frame dump, a session or a video
+    file.
+
+    Images in a directory are played in name order. Raw dumps are
+    unpadded frames back to back, '.bgr' files 3 bytes a pixel and
+    '.gray' files 1 byte a pixel, so they need `resolution`. '.session'
+    files are recorded by SessionRecorder, anything else is opened with
+    cv2.VideoCapture. Frames are cropped by `zoom`
+    and scaled to `resolution` just as the camera would, so a
+    RegionOfInterest can be applied to full recorded frames.
+
+    With realtime set, frames come at `framerate`, otherwise as fast as
+    they can be read; pair that with the BLOCK handoff policy to have
+    every frame processed. Recording stops by itself at the end of the
+    file unless `loop` is set."""
+
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+    RAW_CHANNELS = {'.bgr': 3, '.gray': 1}
+    SESSION_EXTENSION = '.session'
+
+    def __init__(self, path, resolution=None, framerate=30, realtime=True,
+                 loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self._raw_resolution = resolution
+        # kept open while frames from it may be in use
+        self._session = None
+        first = next(self._read(), None)
+        if first is None:
+            raise IOError('no frames in %s' % path)
+        self.native_resolution = (first.shape[1], first.shape[0])
+        super(FileSource, self).__init__(
+            resolution or self.native_resolution, framerate
+        )
+        self._thread = None
+        self._error = None
+        self._position = 0
+
+    def _read(self):
+        """Yield the frames in the file as BGR or greyscale arrays"""
+        extension = os.path.splitext(self.path)[1].lower()
+        if os.path.isdir(self.path):
+            names = sorted(
+                name for name in os.listdir(self.path)
+                if os.path.splitext(name)[1].lower() in self.IMAGE_EXTENSIONS
+            )
+            for name in names:
+                yield cv2.imread(
+                    os.path.join(self.path, name), cv2.IMREAD_UNCHANGED
+                )
+        elif extension in self.RAW_CHANNELS:
+            if self._raw_resolution is None:
+                raise ValueError('raw frame dumps need a resolution')
+            width, height = self._raw_resolution
+            channels = self.RAW_CHANNELS[extension]
+            shape = (height, width, channels) if channels > 1 else (height, width)
+            size = width * height * channels
+            with open(self.path, 'rb') as f:
+                while True:
+                    data = f.read(size)
+                    if len(data) < size:
+                        break
+                    yield numpy.frombuffer(data, dtype=numpy.uint8).reshape(shape)
+        elif extension == self.SESSION_EXTENSION:
+            if self._session is None:
+                self._session = Session(self.path)
+            for n in range(len(self._session)):
+                yield self._session.frame(n)
+        else:
+            video = cv2.VideoCapture(self.path)
+            try:
+                while True:
+                    ok, image = video.read()
+                    if not ok:
+                        break
+                    yield image
+            finally:
+                video.release()
+
+    def frames(self):
+        """The recorded frames as they were stored, without cropping or
+        scaling"""
+        return self._read()
+
+    def cropped_frames(self):
+        """The recorded frames cropped by `zoom` and scaled to
+        `resolution`, as a recording would deliver them"""
+        for image in self._read():
+            yield self._crop(image)
+
+    def start_recording(self, output, format='bgr', **options):
+        width, height = self.resolution
+        padded_width, padded_height = raw_resolution(self.resolution)
+        luma_size = padded_width * padded_height
+        if format == 'yuv':
+            self._buffer = numpy.empty(luma_size * 3 // 2, dtype=numpy.uint8)
+            # no colour, so the chroma planes stay neutral
+            self._buffer[luma_size:] = 128
+            plane = self._buffer[:luma_size].reshape(padded_height, padded_width)
+        elif format == 'bgr':
+            self._buffer = numpy.zeros(luma_size * 3, dtype=numpy.uint8)
+            plane = self._buffer.reshape(padded_height, padded_width, 3)
+        else:
+            raise ValueError('unsupported format %s' % format)
+        self._plane = plane[:height, :width]
+        self._format = format
+        self._output = output
+        self._error = None
+        self.recording = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            # carry on from where the last recording stopped, as the
+            # camera would
+            skip = self._position
+            played = 0
+            start_time = time.time()
+            while self.recording:
+                for image in self._read():
+                    if not self.recording:
+                        break
+                    if skip:
+                        skip -= 1
+                        continue
+                    if self.realtime:
+                        delay = start_time + float(played) / self.framerate - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self._encode(image)
+                    self.frame = SourceFrame(self._position, self.timestamp)
+                    self._output.write(self._buffer.data)
+                    self._position += 1
+                    played += 1
+                if not self.loop:
+                    break
+        except Exception as e:
+            logger.exception('replaying %s failed', self.path)
+            self._error = e
+        finally:
+            self.recording = False
+
+    def _crop(self, image):
+        """Crop a frame by zoom and scale it to the resolution"""
+        native_height, native_width = image.shape[:2]
+        x, y, w, h = self.zoom
+        left, top = int(x * native_width), int(y * native_height)
+        image = image[
+            top:top + int(round(h * native_height)),
+            left:left + int(round(w * native_width))
+        ]
+        if image.shape[1::-1] != tuple(self.resolution):
+            image = cv2.resize(
+                image, tuple(self.resolution), interpolation=cv2.INTER_AREA
+            )
+        return image
+
+    def _encode(self, image):
+        """Crop, scale and convert a frame into the output buffer"""
+        image = self._crop(image)
+        if self._format == 'yuv':
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        elif image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        self._plane[...] = image
+
+    def wait_recording(self, timeout=0):
+        super(FileSource, self).wait_recording(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def stop_recording(self):
+        self.recording = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._output.flush()
+
+    def close(self):
+        super(FileSource, self).close()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
@@ -0,0 +1,114 @@
+# Per-frame timing records and rolling latency histograms, used to find
+# out whether time goes in the camera, the vision code or the motors
+import logging
+import time
+
+import numpy
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class FrameInfo(object):
+    """Timing record that travels with a frame. All times are
+    time.time() seconds, apart from `timestamp` which is the camera's
+    own presentation timestamp in microseconds (None if unknown)"""
+
+    __slots__ = (
+        'index', 'timestamp', 'exposed', 'captured', 'handed_off',
+        'started', 'finished', 'motor', 'stages'
+    )
+
+    def __init__(self):
+        self.stages = []
+        self.reset()
+
+    def reset(self, index=0, timestamp=None, captured=0.0, exposed=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.captured = captured
+        # without a camera timestamp, the best guess is when we got it
+        self.exposed = captured if exposed is None else exposed
+        self.handed_off = None
+        self.started = None
+        self.finished = None
+        self.motor = None
+        del self.stages[:]
+
+    def stage(self, name):
+        """Mark the end of a named processing stage"""
+        self.stages.append((name, time.time()))
+
+    def intervals(self):
+        """Yield (name, seconds) for every interval we have both ends of"""
+        if self.handed_off is not None:
+            yield 'camera', self.captured - self.exposed
+            yield 'handoff', self.handed_off - self.captured
+        if self.started is not None:
+            last = self.started
+            for name, when in self.stages:
+                yield name, when - last
+                last = when
+            if self.finished is not None:
+                yield 'process', self.finished - self.started
+            if self.motor is not None:
+                yield 'motor', self.motor - self.started
+                yield 'total', self.motor - self.exposed
+
+
+class RollingHistogram(object):
+    """Keeps the last `window` samples and reports percentiles over them"""
+
+    def __init__(self, window=300):
+        self._samples = numpy.zeros(window)
+        self._next = 0
+        self.count = 0
+
+    def add(self, value):
+        self._samples[self._next] = value
+        self._next = (self._next + 1) % len(self._samples)
+        self.count += 1
+
+    @property
+    def samples(self):
+        return self._samples[:min(self.count, len(self._samples))]
+
+    def percentiles(self, percents=(50, 95, 99)):
+        if not self.count:
+            return tuple(0.0 for _ in percents)
+        return tuple(numpy.percentile(self.samples, percents))
+
+    def histogram(self, bins=10):
+        """Bucket counts and edges of the samples in the window"""
+        return numpy.histogram(self.samples, bins=bins)
+
+
+class LatencyStats(object):
+    """Rolling latency histograms, one per interval name reported by
+    FrameInfo.intervals()"""
+
+    def __init__(self, window=300):
+        self.window = window
+        self.histograms = {}
+
+    def add(self, info):
+        for name, seconds in info.intervals():
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = RollingHistogram(
+                    self.window
+                )
+            histogram.add(seconds)
+
+    def summary(self):
+        """{interval name: (p50, p95, p99)} in milliseconds"""
+        return dict(
+            (name, tuple(p * 1000 for p in histogram.percentiles()))
+            for name, histogram in self.histograms.items()
+        )
+
+    def log(self, name=''):
+        for interval, (p50, p95, p99) in sorted(self.summary().items()):
+            logger.info(
+                '%s %s latency p50: %.1f ms, p95: %.1f ms, p99: %.1f ms',
+                name, interval, p50, p95, p99
+            )
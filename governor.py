@@ -0,0 +1,110 @@
+# Adapts capture resolution and framerate to how long processing takes,
+# instead of silently dropping frames when a stream processor can't keep up
+import logging
+import time
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class Governor(object):
+    """Steps a challenge down a ladder of (scale, framerate) levels when
+    processing overruns the frame interval, and back up when there's
+    room again.
+
+    `levels` runs from the challenge's normal setting down to the
+    cheapest it can still work at, and is all the governor will ever
+    pick from. The first level is usually (1.0, framerate). scale
+    applies to the RegionOfInterest, so the field of view stays the
+    same and only the number of pixels changes.
+
+    Load is the mean processing time over the last WINDOW frames as a
+    share of the frame interval. Above HIGH_LOAD it steps down. It steps
+    up when the load predicted for the next level up, going by its pixel
+    count and framerate, is under LOW_LOAD. The gap between the two and
+    HOLD_TIME after each change stop it hunting between two levels.
+
+    The stream processor feeds it with add(). A change is only marked
+    as `pending`; ImageCapture makes it between recordings by calling
+    apply()."""
+
+    HIGH_LOAD = 0.9
+    LOW_LOAD = 0.6
+    WINDOW = 30  # frames
+    HOLD_TIME = 2.0  # seconds after a change before the next
+
+    def __init__(self, roi, levels):
+        self.levels = [
+            (scale, framerate, roi.scaled(scale))
+            for scale, framerate in levels
+        ]
+        self.level = 0
+        self.pending = None
+        self.load = 0.0
+        self.transitions = []
+        self._times = []
+        self._changed = time.time()
+
+    @property
+    def scale(self):
+        return self.levels[self.level][0]
+
+    @property
+    def framerate(self):
+        return self.levels[self.level][1]
+
+    @property
+    def roi(self):
+        return self.levels[self.level][2]
+
+    @property
+    def next_roi(self):
+        """The RegionOfInterest the pending change will switch to"""
+        return self.levels[self.pending][2]
+
+    def cost(self, level):
+        """Processing cost of a level relative to the current one"""
+        scale, framerate = self.levels[level][:2]
+        return ((float(scale) / self.scale) ** 2 *
+                float(framerate) / float(self.framerate))
+
+    def add(self, process_time):
+        """Record how long a frame took to process, and mark a change as
+        pending if the load calls for one"""
+        if self.pending is not None:
+            return
+        self._times.append(process_time)
+        if len(self._times) < self.WINDOW:
+            return
+        self.load = (sum(self._times) * float(self.framerate) /
+                     len(self._times))
+        self._times = []
+        if time.time() - self._changed < self.HOLD_TIME:
+            return
+        if self.load > self.HIGH_LOAD and self.level < len(self.levels) - 1:
+            self.pending = self.level + 1
+        elif (self.level > 0 and
+              self.load * self.cost(self.level - 1) < self.LOW_LOAD):
+            self.pending = self.level - 1
+
+    def apply(self, camera):
+        """Switch the camera to the pending level. Recording has to be
+        stopped"""
+        old = self.describe()
+        self.level, self.pending = self.pending, None
+        self.roi.apply(camera)
+        if camera.framerate != self.framerate:
+            camera.framerate = self.framerate
+        self._times = []
+        self._changed = time.time()
+        self.transitions.append((self._changed, self.level, self.load))
+        logger.info(
+            'load %.2f, changed from %s to %s', self.load, old,
+            self.describe()
+        )
+
+    def describe(self, level=None):
+        scale, framerate, roi = self.levels[
+            self.level if level is None else level
+        ]
+        width, height = roi.window_resolution
+        return '%dx%d@%s' % (width, height, framerate)
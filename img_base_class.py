@@ -13,20 +13,480 @@ sys.path.append('/usr/local/lib/python2.7/site-packages')
 import threading
 import pygame
 from pygame.locals import*
-import sgc
-from sgc.locals import *
-import picamera
-import picamera.array
 import cv2
 import numpy
 from fractions import Fraction
 from base_challenge import BaseChallenge
+from frame_timing import FrameInfo, LatencyStats
+from workspace import Workspace
+from diagnostics import Diagnostics
+from overlay import Overlay
+from frame_source import raw_resolution
 
 logging.config.fileConfig('logging.ini')
 logger = logging.getLogger('piradigm.' + __name__)
 logger.debug('Libraries loaded')
 
 
+def padded_frame_shape(resolution, format):
+    """numpy shape of a padded frame as kept by the camera outputs, for
+    the FrameRing.BGR and FrameRing.LUMA formats"""
+    padded_width, padded_height = raw_resolution(resolution)
+    if format == FrameRing.LUMA:
+        return (padded_height, padded_width)
+    return (padded_height, padded_width, 3)
+
+
+def stamp_frame(camera, info, index):
+    """Fill in when the frame being written was captured and, if the
+    camera can tell us, when it was exposed.
+
+    That relies on frame.timestamp and camera.timestamp being on the same
+    clock, which for a PiCamera means opening it with clock_mode 'raw':
+    by default frame timestamps count from the start of recording and
+    the camera's from boot. CameraService does"""
+    captured = time.time()
+    exposed = None
+    frame = getattr(camera, 'frame', None)
+    timestamp = getattr(frame, 'timestamp', None)
+    if timestamp is not None:
+        # both in microseconds on the camera's raw clock
+        age = camera.timestamp - timestamp
+        exposed = captured - age / 1000000.0
+    info.reset(index, timestamp, captured, exposed)
+
+
+def mirrored_surface(workspace, name, image):
+    """pygame surface of an image flipped left to right, the way the
+    touchscreen shows frames. The flipped image and the surface are kept
+    in the workspace under name and reused while the size stays the
+    same"""
+    flipped = cv2.flip(image, 1, dst=workspace.like(name, image))
+    shape, surface = workspace.surfaces.get(name, (None, None))
+    if shape != flipped.shape:
+        surface = pygame.surfarray.make_surface(flipped)
+        workspace.surfaces[name] = (flipped.shape, surface)
+    else:
+        pygame.surfarray.blit_array(surface, flipped)
+    return surface
+
+
+class RegionOfInterest(object):
+    """Declares the part of the field of view a challenge actually looks
+    at, so the GPU crops and scales to just that window instead of the
+    processor throwing most of every frame away.
+
+    Rectangles are (x, y, width, height) in pixels of a full frame at
+    `resolution`. `window` is the rectangle the camera delivers, at the
+    same scale as the full frame so pixel based constants still hold.
+    `regions` are named rectangles inside it (also in full frame
+    pixels), which views() returns as numpy views of the one buffer.
+    The sensor mode is pinned so the zoom is always relative to the
+    same full 4:3 field of view, whatever shape the window is."""
+
+    def __init__(self, resolution, window, regions=None, sensor_mode=4):
+        self.resolution = resolution
+        self.window = window
+        self.sensor_mode = sensor_mode
+        win_x, win_y = window[:2]
+        self.regions = dict(
+            (name, (x - win_x, y - win_y, w, h))
+            for name, (x, y, w, h) in (regions or {}).items()
+        )
+
+    @property
+    def zoom(self):
+        """The window as a camera.zoom rectangle"""
+        width, height = self.resolution
+        x, y, w, h = self.window
+        return (
+            float(x) / width, float(y) / height,
+            float(w) / width, float(h) / height
+        )
+
+    @property
+    def window_resolution(self):
+        return tuple(self.window[2:])
+
+    def apply(self, camera):
+        """Set up the camera to deliver just the window. Sensor mode and
+        resolution changes restart the camera, so they're only made if
+        needed"""
+        if self.sensor_mode is not None and camera.sensor_mode != self.sensor_mode:
+            camera.sensor_mode = self.sensor_mode
+        if tuple(camera.resolution) != self.window_resolution:
+            camera.resolution = self.window_resolution
+        camera.zoom = self.zoom
+
+    def scaled(self, scale):
+        """The same field of view and regions at `scale` times the
+        resolution"""
+        if scale == 1:
+            return self
+        def rect(values):
+            return tuple(int(round(value * scale)) for value in values)
+        win_x, win_y = self.window[:2]
+        regions = dict(
+            (name, rect((x + win_x, y + win_y, w, h)))
+            for name, (x, y, w, h) in self.regions.items()
+        )
+        return RegionOfInterest(
+            rect(self.resolution), rect(self.window), regions,
+            self.sensor_mode
+        )
+
+    def view(self, image, name):
+        x, y, w, h = self.regions[name]
+        return image[y:y + h, x:x + w]
+
+    def views(self, image):
+        return dict((name, self.view(image, name)) for name in self.regions)
+
+
+class FrameHandoff(object):
+    """Hands buffer slots between the camera and processor threads.
+
+    Built on a condition variable rather than polling: publish() wakes
+    a processor waiting in take() the moment a frame is ready, and
+    release() wakes a camera thread waiting in claim() for a free slot
+    (BLOCK policy). The time each frame spent between publish() and
+    take() is kept in `latency`.
+
+    Policies decide what happens when a new frame arrives while the
+    previous one is still unread: LATEST overwrites it (`overwritten`),
+    OLDEST discards the new frame (`dropped`) and BLOCK makes the
+    camera wait until the processor has taken it.
+
+    It needs at least two slots, one for the processor to hold and one
+    for the camera to write into."""
+
+    LATEST = 'latest'
+    OLDEST = 'oldest'
+    BLOCK = 'block'
+
+    def __init__(self, slots, policy=LATEST):
+        if slots < 2:
+            raise ValueError('a frame handoff needs at least 2 slots')
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._free = list(range(slots))
+        self._ready = None
+        self._held = None
+        self._published = [0.0] * slots
+        self.closed = False
+        self.written = 0
+        self.overwritten = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.taken = 0
+
+    def claim(self):
+        """Camera side: get a slot to write the next frame into, or None
+        if the frame should be dropped"""
+        with self._cond:
+            if self.policy == self.BLOCK:
+                while not self.closed and (
+                    self._ready is not None or not self._free
+                ):
+                    self._cond.wait()
+            if self.closed:
+                return None
+            if self._ready is not None and self.policy == self.OLDEST:
+                self.dropped += 1
+                return None
+            if self._free:
+                return self._free.pop()
+            if self._ready is None:
+                # nothing free and nothing waiting to be read, which
+                # enough slots rule out, but there's nowhere to write
+                self.dropped += 1
+                return None
+            # every other slot is either held or waiting to be read,
+            # so take over the one that's waiting
+            slot, self._ready = self._ready, None
+            self.overwritten += 1
+            return slot
+
+    def publish(self, slot):
+        """Camera side: mark a claimed slot as the newest frame"""
+        with self._cond:
+            if self._ready is not None:
+                self._free.append(self._ready)
+                self.overwritten += 1
+            self._ready = slot
+            self._published[slot] = time.time()
+            self.written += 1
+            self._cond.notify_all()
+
+    def take(self, timeout=None):
+        """Processor side: wait for the newest frame and take ownership
+        of its slot. Returns None if closed or nothing arrived within
+        timeout. Python 2's Condition.wait polls when given a timeout,
+        so the frame loop waits without one and relies on close()"""
+        with self._cond:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while self._ready is None and not self.closed:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if self._ready is None or self.closed:
+                return None
+            self._held, self._ready = self._ready, None
+            self.latency = time.time() - self._published[self._held]
+            self.total_latency += self.latency
+            self.max_latency = max(self.max_latency, self.latency)
+            self.taken += 1
+            return self._held
+
+    def release(self):
+        """Processor side: hand the slot taken by take() back"""
+        with self._cond:
+            if self._held is not None:
+                self._free.append(self._held)
+                self._held = None
+                self._cond.notify_all()
+
+    def drain(self):
+        """Wait for the processor to hand back its slot and discard any
+        frame it hasn't taken, leaving every slot free. Only for when
+        the camera is stopped"""
+        with self._cond:
+            while self._held is not None and not self.closed:
+                self._cond.wait()
+            if self._ready is not None:
+                self._free.append(self._ready)
+                self._ready = None
+
+    def close(self):
+        """Wake up everything waiting on the handoff so it can exit"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.taken if self.taken else 0.0
+
+
+class FrameRing(object):
+    """Custom camera output that writes frames straight into a ring of
+    preallocated numpy buffers.
+
+    The camera calls write() once per frame from its own thread. The
+    stream processor calls acquire() to take the newest complete frame
+    and release() to hand the buffer back when it's done with it. Which
+    buffer goes where is decided by a FrameHandoff, see there for the
+    drop policies. Each buffer has a FrameInfo timing record; the one
+    for the frame last acquired is `current`. Nothing is allocated per
+    frame once the ring is built.
+
+    Frames are BGR by default. In LUMA format the camera records YUV420
+    and only the Y plane is copied, giving the processor a 2-D greyscale
+    array with a third of the memory traffic and no colour conversion."""
+
+    BGR = 'bgr'
+    LUMA = 'luma'
+
+    def __init__(self, camera, buffers=3, policy=FrameHandoff.LATEST,
+                 format=BGR):
+        if buffers < 2:
+            raise ValueError('a frame ring needs at least 2 buffers')
+        self.camera = camera
+        self.format = format
+        # what to ask the camera for; write() keeps just the Y plane of yuv
+        self.camera_format = 'yuv' if format == self.LUMA else 'bgr'
+        width, height = camera.resolution
+        shape = padded_frame_shape(camera.resolution, format)
+        self._buffers = [
+            numpy.empty(shape, dtype=numpy.uint8) for _ in range(buffers)
+        ]
+        # what the processor sees: the buffers with the padding cropped off
+        self._frames = [buf[:height, :width] for buf in self._buffers]
+        self._flat = [buf.reshape(-1) for buf in self._buffers]
+        self._info = [FrameInfo() for _ in self._buffers]
+        self.current = None
+        self.index = 0
+        self.handoff = FrameHandoff(buffers, policy)
+
+    @property
+    def output(self):
+        """What ImageCapture records into"""
+        return self
+
+    def write(self, buf):
+        """Called by the camera with one complete frame"""
+        slot = self.handoff.claim()
+        if slot is not None:
+            stamp_frame(self.camera, self._info[slot], self.index)
+            self.index += 1
+            flat = self._flat[slot]
+            # in LUMA format this stops at the end of the Y plane
+            size = min(len(buf), flat.size)
+            flat[:size] = numpy.frombuffer(buf, dtype=numpy.uint8, count=size)
+            self.handoff.publish(slot)
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def resize(self, resolution):
+        """Switch to frames of a new resolution, no bigger than the one
+        the ring was made for, reusing the same buffers. Only for when
+        the camera is stopped"""
+        shape = padded_frame_shape(resolution, self.format)
+        size = int(numpy.prod(shape))
+        if size > self._buffers[0].size:
+            raise ValueError('frame ring is too small for %dx%d' % resolution)
+        width, height = resolution
+        self.handoff.drain()
+        self._flat = [buf.reshape(-1)[:size] for buf in self._buffers]
+        self._frames = [
+            flat.reshape(shape)[:height, :width] for flat in self._flat
+        ]
+
+    def acquire(self, timeout=None):
+        """Wait for a new frame and take ownership of it. Returns a numpy
+        view of the frame, or None once the ring is closed"""
+        slot = self.handoff.take(timeout)
+        if slot is None:
+            return None
+        self.current = self._info[slot]
+        self.current.handed_off = time.time()
+        return self._frames[slot]
+
+    def release(self):
+        """Hand the frame taken by acquire() back to the camera"""
+        self.handoff.release()
+
+    def close(self):
+        self.handoff.close()
+
+    def log_stats(self):
+        handoff = self.handoff
+        logger.info(
+            'frames written: %d, overwritten: %d, dropped: %d',
+            handoff.written, handoff.overwritten, handoff.dropped
+        )
+        logger.info(
+            'frame handoff latency mean: %.2f ms, max: %.2f ms',
+            handoff.mean_latency * 1000, handoff.max_latency * 1000
+        )
+
+
+# Image stream processing thread
+class BaseStreamProcessor(threading.Thread):
+    """Frame loop shared by the challenge stream processors. Subclasses
+    implement process_image(image, screen), and can mark the end of each
+    stage in it with self.frame_info.stage(name) to have it timed in
+    self.latency. Pass format=FrameRing.LUMA to get greyscale frames.
+    If the challenge declared a RegionOfInterest, frames are already
+    cropped to its window and self.roi gives views of its regions.
+
+    Frames come from a private FrameRing unless `frames` is given, e.g.
+    a FrameBus subscription shared with other consumers.
+
+    self.workspace holds buffers for process_image to write each stage
+    into, rather than allocating new arrays every frame. Anything only
+    a person watching needs goes through self.diagnostics, and is drawn
+    with self.overlay.
+
+    With a Governor, processing times are fed to it and when it changes
+    level the image size, the roi and the attributes named in SCALED
+    and PER_FRAME are rescaled to match before the first frame at the
+    new level is processed"""
+
+    # pixel constants and the power of the image scale they go by: 1 for
+    # lengths, 2 for areas, -2 for gains applied to an area
+    SCALED = {}
+    # gains applied to the change in something from one frame to the
+    # next, which go by the framerate
+    PER_FRAME = ()
+
+    def __init__(self, screen=None, camera=None, drive=None,
+                 format=FrameRing.BGR, roi=None, frames=None, governor=None):
+        super(BaseStreamProcessor, self).__init__()
+        self.camera = camera
+        self.roi = roi
+        self.image_width, self.image_height = self.camera.resolution
+        self.image_centre_x = self.image_width / 2.0
+        self.image_centre_y = self.image_height / 2.0
+        self.drive = drive
+        self.screen = screen
+        self.frames = frames or FrameRing(camera, format=format)
+        self.frame_info = None
+        self.latency = LatencyStats()
+        self.workspace = Workspace()
+        self.diagnostics = Diagnostics()
+        self.overlay = Overlay()
+        self.governor = governor
+        self.level = 0
+        self._unscaled = None
+        self.terminated = False
+
+    def run(self):
+        # This method runs in a separate thread
+        while not self.terminated:
+            # Wait for the camera to write a frame into the ring
+            image = self.frames.acquire()
+            if image is not None:
+                info = self.frame_info = self.frames.current
+                logger.debug(
+                    'frame handoff latency %.2f ms',
+                    (info.handed_off - info.captured) * 1000
+                )
+                governor = self.governor
+                if governor is not None and governor.level != self.level:
+                    self.rescale(governor)
+                info.started = time.time()
+                try:
+                    self.process_image(image, self.screen)
+                finally:
+                    info.finished = time.time()
+                    # Hand the buffer back to the camera
+                    self.frames.release()
+                last_move_time = getattr(self.drive, 'last_move_time', 0)
+                if last_move_time >= info.started:
+                    info.motor = last_move_time
+                self.latency.add(info)
+                if governor is not None:
+                    governor.add(info.finished - info.started)
+
+    def rescale(self, governor):
+        """Match the image size and scaled attributes to the governor's
+        current level, relative to their values at its first level"""
+        names = set(self.SCALED) | set(self.PER_FRAME)
+        if self._unscaled is None:
+            self._unscaled = dict((name, getattr(self, name)) for name in names)
+        rate = float(governor.framerate) / float(governor.levels[0][1])
+        for name in names:
+            factor = governor.scale ** self.SCALED.get(name, 0)
+            if name in self.PER_FRAME:
+                factor *= rate
+            value = self._unscaled[name]
+            if isinstance(value, (list, tuple)):
+                value = type(value)(item * factor for item in value)
+            else:
+                value = value * factor
+            setattr(self, name, value)
+        self.roi = governor.roi
+        self.image_width, self.image_height = self.roi.window_resolution
+        self.image_centre_x = self.image_width / 2.0
+        self.image_centre_y = self.image_height / 2.0
+        # buffers come back at the new size as they're asked for
+        self.workspace.clear()
+        self.level = governor.level
+
+    def process_image(self, image, screen):
+        pass
+
+
 # Image capture thread
 class ImageCapture(threading.Thread):
     def __init__(self, camera=None, processor=None):
@@ -37,22 +497,32 @@ class ImageCapture(threading.Thread):
         self.start()
 
     def run(self):
-        logger.debug('Start the stream using the video port')
-        self.camera.capture_sequence(
-            self.trigger_stream(),
-            format='bgr',
-            use_video_port=True
-        )
+        logger.debug('Start recording into the frame ring using the video port')
+        output = self.processor.frames.output
+        try:
+            self.camera.start_recording(output, format=output.camera_format)
+            # a recording from a file stops by itself at the end
+            while not self.terminated and self.camera.recording:
+                self.camera.wait_recording(0.1)
+                governor = self.processor.governor
+                if governor is not None and governor.pending is not None:
+                    self.change_level(governor, output)
+            self.camera.stop_recording()
+        finally:
+            # wake the processor up so it sees it has been terminated
+            self.processor.terminated = True
+            output.close()
+        output.log_stats()
         logger.debug('Terminating camera processing...')
-        self.processor.terminated = True
         self.processor.join()
         logger.debug('Processing terminated.')
-                        
-    # Stream delegation loop
-    def trigger_stream(self):
-        while not self.terminated:
-            if self.processor.event.is_set():
-                time.sleep(0.01)
-            else:
-                yield self.processor.stream
-                self.processor.event.set()
+
+    def change_level(self, governor, output):
+        """Restart recording at the resolution and framerate the governor
+        has asked for"""
+        self.camera.stop_recording()
+        resolution = governor.next_roi.window_resolution
+        if resolution != tuple(self.camera.resolution):
+            output.resize(resolution)
+        governor.apply(self.camera)
+        self.camera.start_recording(output, format=output.camera_format)
@@ -1,22 +1,26 @@
 from img_base_class import *
-import cv2.aruco as aruco
+from detection_pool import ArucoDetector, MarkerDetection
+from governor import Governor
+from debug_capture import capture_for
 
 # Image stream processing thread
-class StreamProcessor(threading.Thread):
-    def __init__(self, screen=None, camera=None, drive=None, dict=None):
-        super(StreamProcessor, self).__init__()
-        self.camera = camera
-        image_width, image_height = self.camera.resolution
-        self.image_centre_x = image_width / 2.0
-        self.image_centre_y = image_height / 2.0
-        self.drive = drive
-        self.screen = screen
-        self.stream = picamera.array.PiRGBArray(camera)
-        self.event = threading.Event()
-        self.terminated = False
-        # Why the one second sleep?
+class StreamProcessor(MarkerDetection, BaseStreamProcessor):
+    SCALED = {'CROP_WIDTH': 1, 'TURN_WIDTH': 1}
+    PER_FRAME = ('TURN_D',)
+
+    def __init__(self, screen=None, camera=None, drive=None, dict=None,
+                 roi=None, pool=None, governor=None, capture=None):
+        # ArUco detection only needs greyscale
+        super(StreamProcessor, self).__init__(
+            screen=screen, camera=camera, drive=drive, format=FrameRing.LUMA,
+            roi=roi, governor=governor
+        )
         #create small cust dictionary
         self.small_dict = dict #aruco.Dictionary_create(6, 3)
+        self.detector = ArucoDetector(dictionary=dict)
+        self.pool = pool
+        # saves frames for debugging, if it's not None
+        self.capture = capture
         self.last_t_error = 0
         self.TURN_P = 0.9
         self.TURN_D = 0.5
@@ -41,52 +45,46 @@ class StreamProcessor(threading.Thread):
         self.BRAKE_TIME = 0.05
         self.finished = False
         logger.info("setup complete, looking")
-        time.sleep(1)
         self.start()
 
-    def run(self):
-        # This method runs in a separate thread
-        while not self.terminated:
-            # Wait for an image to be written to the stream
-            if self.event.wait(1):
-                try:
-                    # Read the image and do some processing on it
-                    self.stream.seek(0)
-                    self.process_image(self.stream.array, self.screen)
-                finally:
-                    # Reset the stream and event
-                    self.stream.seek(0)
-                    self.stream.truncate()
-                    self.event.clear()
-
-    def turn_right(self):
-        self.drive.move(self.NINTY_TURN, 0)
-        time.sleep(self.TURN_TIME)
-        self.drive.move(0,0)
-        time.sleep(self.SETTLE_TIME)
+    def turn_right(self, brake=False):
+        self.turn(self.NINTY_TURN, brake)
                 
-    def turn_left(self):
-        self.drive.move(-self.NINTY_TURN, 0)
-        time.sleep(self.TURN_TIME)
-        self.drive.move(0,0)
-        time.sleep(self.SETTLE_TIME)
+    def turn_left(self, brake=False):
+        self.turn(-self.NINTY_TURN, brake)
 
-    def brake(self):
-        self.drive.move(0,-self.BRAKING_FORCE)
-        time.sleep(self.BRAKE_TIME)
-        self.drive.move(0,0)
+    def turn(self, amount, brake=False):
+        """Pulse round looking for the next marker, braking first if asked.
+        Frames keep coming while it turns, and steering towards a marker
+        cuts it short; a turn still going isn't started again"""
+        if self.drive.busy:
+            return
+        steps = []
+        if brake:
+            steps.append((0, -self.BRAKING_FORCE, self.BRAKE_TIME))
+        steps.append((amount, 0, self.TURN_TIME))
+        steps.append((0, 0, self.SETTLE_TIME))
+        self.drive.sequence(steps)
     
     def process_image(self, image, screen):
         screen = pygame.display.get_surface()
         if self.turn_number >= self.TURN_TARGET:
            logger.info("finished!")
            self.finished = True
-        frame = image[75:255, (self.image_centre_x - self.CROP_WIDTH/2):(self.image_centre_x + self.CROP_WIDTH/2)]
+        # the camera delivers just the CROP_WIDTH wide band we look in
+        frame = image
         # Our operations on the frame come here
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        parameters =  aruco.DetectorParameters_create()
+        # the frame is already greyscale, straight from the Y plane
+        gray = frame
         #lists of ids and the corners beloning to each id
-        corners, ids, rejectedImgPoints = aruco.detectMarkers(gray, self.small_dict, parameters=parameters)
+        detected = self.detect(gray)
+        self.frame_info.stage('detect')
+        if detected is None:
+            # nothing back from the detection pool since the last frame
+            self.wait_for_detection()
+            self.finish_frame(frame, screen)
+            return
+        corners, ids = detected
         if ids != None:
             if len(ids)>1:
                 logger.info( "found %d markers" % len(ids))
@@ -100,7 +98,7 @@ class StreamProcessor(threading.Thread):
             if ids[self.marker_to_track][0] == self.turn_number:
                 m = self.marker_to_track
                 self.found = True
-                #if found, comptue the centre and move the cursor there
+                #if found, comptue the centre and put the crosshair there
                 found_y = sum([arr[0] for arr in corners[m][0]])  / 4
                 found_x = sum([arr[1] for arr in corners[m][0]])  / 4
                 width = abs(corners[m][0][0][0]-corners[m][0][1][0]+corners[m][0][3][0]-corners[m][0][2][0])/2
@@ -113,7 +111,7 @@ class StreamProcessor(threading.Thread):
                         logger.info('finished!')
                         self.drive.move(0,0)
                         self.finished = True
-                pygame.mouse.set_pos(int(found_x), int(self.CROP_WIDTH-found_y))
+                self.overlay.crosshair((int(found_x), int(self.CROP_WIDTH-found_y)))
                 self.t_error = (self.CROP_WIDTH/2 - found_y) / (self.CROP_WIDTH / 2)
                 turn = self.STEERING_OFFSET + self.TURN_P * self.t_error
                 if self.last_t_error is not 0:
@@ -132,13 +130,9 @@ class StreamProcessor(threading.Thread):
                     self.drive.move(0,0)
                 else:
                     if self.turn_number <= 2:
-                        if self.turn_number == 1:
-                            self.brake()
-                        self.turn_right()
+                        self.turn_right(brake=self.turn_number == 1)
                     else:
-                        if self.turn_number == 4:
-                            self.brake()
-                        self.turn_left()
+                        self.turn_left(brake=self.turn_number == 4)
                 self.found = False
                 self.last_t_error = 0 
         else:
@@ -149,24 +143,28 @@ class StreamProcessor(threading.Thread):
             else:
                 #otherwise, go looking
                 if self.turn_number <= 2:
-                    if self.turn_number == 1:
-                        self.brake()
-                    self.turn_right()
+                    self.turn_right(brake=self.turn_number == 1)
                 else:
-                    if self.turn_number == 4:
-                        self.brake()
-                    self.turn_left()
+                    self.turn_left(brake=self.turn_number == 4)
             self.found = False
             self.last_t_error = 0
-        # Display the resulting frame
-        frame = pygame.surfarray.make_surface(cv2.flip(frame,1))
+        self.finish_frame(frame, screen)
+
+    def finish_frame(self, gray, screen):
+        """Display the frame, save it for debugging if asked to and count
+        it, whether or not there was a detection result for it"""
+        frame = mirrored_surface(self.workspace, 'frame', gray)
         screen.fill([0,0,0])
         screen.blit(frame, (0,0))
+        self.overlay.draw(screen)
         pygame.display.update()
-        found_identifier = "F" if self.found else "NF"
-        img_name = "%d%simg.jpg" % (self.i, found_identifier)
-        # filesave for debugging: 
-        cv2.imwrite(img_name, gray)
+        if self.capture is not None:
+            found_identifier = "F" if self.found else "NF"
+            img_name = "%d%simg.jpg" % (self.i, found_identifier)
+            self.capture.capture(img_name, gray, self.found, {
+                'found': self.found, 'turn_number': self.turn_number,
+                't_error': self.last_t_error, 'command': self.drive.command,
+            })
         self.i += 1
 
 
@@ -174,36 +172,64 @@ class StreamProcessor(threading.Thread):
 class Maze(BaseChallenge):
     """Minimal Maze challenge class"""
 
-    def __init__(self, timeout=120, screen=None, joystick=None, markers=None):
-        self.image_width = 480  # Camera image width
-        self.image_height = 360  # Camera image height
+    # Camera image size, and the band of it the markers appear in,
+    # which is all that's captured
+    ROI = RegionOfInterest((480, 360), (0, 75, 480, 180))
+    # (scale, framerate) levels the governor can step down through
+    GOVERNOR_LEVELS = ((1.0, 30), (0.75, 30), (0.75, 20), (0.5, 20))
+    # frames saved for debugging, see debug_capture.capture_for
+    DEBUG_IMAGES = '1'
+
+    def __init__(self, timeout=120, screen=None, joystick=None, markers=None,
+                 camera_service=None, detection_pool=None, debug_images=None,
+                 sessions=None):
         self.frame_rate = 30  # Camera image capture frame rate
+        self.roi = self.ROI
         self.screen = screen
         time.sleep(0.01)
         self.joystick = joystick
         self.dict = markers
-        super(Maze, self).__init__(name='Maze', timeout=timeout, logger=logger)
+        # DetectionPool to run marker detection in, None runs it in the
+        # stream processor thread. It forks, so it's made before any
+        # threads start, by the menu, and kept from challenge to challenge
+        self.pool = detection_pool
+        if debug_images is not None:
+            self.DEBUG_IMAGES = debug_images
+        # directory to record sessions to instead of image files
+        self.sessions = sessions
+        self.capture = None
+        super(Maze, self).__init__(
+            name='Maze', timeout=timeout, logger=logger,
+            camera_service=camera_service
+        )
 
 
     def run(self):
         # Startup sequence
         logger.info('Setting up camera')
         screen = pygame.display.get_surface()
-        self.camera = picamera.PiCamera()
-        self.camera.resolution = (self.image_width, self.image_height)
-        self.camera.framerate = self.frame_rate
-        self.camera.iso = 800
-        self.camera.shutter_speed = 2000
+        self.camera = self.lease_camera(
+            self.roi, self.frame_rate, iso=800, shutter_speed=2000
+        )
+        # steps resolution and framerate down if processing can't keep up
+        self.governor = Governor(self.roi, self.GOVERNOR_LEVELS)
+        if self.pool is not None:
+            self.pool.reset()
+        self.capture = capture_for(
+            self.DEBUG_IMAGES, sessions=self.sessions, name=self.name
+        )
         logger.info('Setup the stream processing thread')
         # TODO: Remove dependency on drivetrain from StreamProcessor
         self.processor = StreamProcessor(
             screen=self.screen,
             camera=self.camera,
             drive=self.drive,
-            dict=self.dict
+            dict=self.dict,
+            roi=self.roi,
+            pool=self.pool,
+            governor=self.governor,
+            capture=self.capture
         )
-        logger.info('Wait ...')
-        time.sleep(2)
         logger.info('Setting up image capture thread')
         self.image_capture_thread = ImageCapture(
             camera=self.camera,
@@ -226,9 +252,14 @@ class Maze(BaseChallenge):
             self.image_capture_thread.join()
             self.processor.terminated = True
             self.processor.join()
-            #release camera
-            self.camera.close()
-            self.camera = None
+            if self.pool is not None:
+                self.pool.log_stats()
+            if self.capture is not None:
+                self.capture.close()
+                self.capture.log_stats()
+                self.capture = None
+            self.log_latency()
+            self.release_camera()
             self.logger.info("stopping drive")
             self.drive.stop()
             pygame.mouse.set_visible(False)
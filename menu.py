@@ -1,12 +1,21 @@
 """ Menu script for Piradigm
 Usage:
-  menu.py [--timeout=<seconds>]
+  menu.py [--timeout=<seconds>] [--detection-workers=<n>] [--debug-images=<when>] [--sessions=<dir>]
   menu.py -h | --help | --version
 
 Options:
   -h --help     Show this screen.
   --version     Show version.
   --timeout=<seconds>  Challenge timeout time in seconds. [default: 120].
+  --detection-workers=<n>  Processes to run marker detection in, 0 to
+                           run it in the stream processor. [default: 0].
+  --debug-images=<when>    Frames to save for debugging: off, changes to
+                           save one whenever what the robot's doing
+                           changes, or n to save every nth frame. Each
+                           challenge's own by default.
+  --sessions=<dir>         Record the frames saved for debugging, and
+                           what was decided on each, to a session file
+                           in this directory instead of image files.
 """
 import logging
 import logging.config
@@ -28,6 +37,8 @@ from rainbow import Rainbow
 from marker_maze import Maze
 from straightline import StraightLineSpeed
 from pi_noon import PiNoon
+from camera_service import CameraService
+from detection_pool import ArucoDetector, DetectionPool
 from approxeng.input.selectbinder import ControllerResource
 import cv2.aruco as aruco
 
@@ -65,7 +76,27 @@ class Menu():
         for var_name, val in env_vars:
             os.environ[var_name] = val
         self.timeout = kwargs.pop('timeout', 120)
+        self.detection_workers = kwargs.pop('detection_workers', 0)
+        # the detection workers are forked first, before anything starts
+        # a thread whose locks they'd inherit, and shared by the marker
+        # challenges
+        self.detection_pool = None
+        if self.detection_workers:
+            logger.info('Starting %d detection workers', self.detection_workers)
+            width, height = max(
+                (challenge.ROI.window_resolution
+                 for challenge in (Maze, StraightLineSpeed)),
+                key=lambda resolution: resolution[0] * resolution[1]
+            )
+            self.detection_pool = DetectionPool(
+                ArucoDetector(), (height, width),
+                workers=self.detection_workers
+            )
+        self.debug_images = kwargs.pop('debug_images', None)
+        self.sessions = kwargs.pop('sessions', None)
         self.markers = aruco.Dictionary_create(6, 3)
+        # one camera, kept open and shared by all the challenges
+        self.camera_service = CameraService()
 
     def launch_challenge(self, new_challenge):
         """launch requested challenge thread"""
@@ -136,19 +167,19 @@ class Menu():
             return new_challenge
         elif event.label is "Rainbow":
             logger.info("launching Rainbow challenge")
-            new_challenge = Rainbow(timeout=self.timeout, screen=self.screen, joystick=self.joystick)
+            new_challenge = Rainbow(timeout=self.timeout, screen=self.screen, joystick=self.joystick, camera_service=self.camera_service)
             return new_challenge
         elif event.label is "Maze":
             logger.info("launching Maze challenge")
-            new_challenge = Maze(timeout=self.timeout, screen=self.screen, joystick=self.joystick, markers = self.markers)
+            new_challenge = Maze(timeout=self.timeout, screen=self.screen, joystick=self.joystick, markers = self.markers, camera_service=self.camera_service, detection_pool=self.detection_pool, debug_images=self.debug_images, sessions=self.sessions)
             return new_challenge
         elif event.label is "Speed":
             logger.info("launching Speed challenge")
-            new_challenge = StraightLineSpeed(timeout=self.timeout, screen=self.screen, joystick=self.joystick, markers = self.markers)
+            new_challenge = StraightLineSpeed(timeout=self.timeout, screen=self.screen, joystick=self.joystick, markers = self.markers, camera_service=self.camera_service, detection_pool=self.detection_pool, debug_images=self.debug_images, sessions=self.sessions)
             return new_challenge
         elif event.label == "Pi Noon":
             logger.info("launching Pi Noon challenge")
-            new_challenge = PiNoon(timeout=self.timeout, screen=self.screen, joystick=self.joystick)
+            new_challenge = PiNoon(timeout=self.timeout, screen=self.screen, joystick=self.joystick, camera_service=self.camera_service, debug_images=self.debug_images, sessions=self.sessions)
             return new_challenge
         elif event.label is "Exit":
             logger.info("Exit button pressed. Exiting now.")
@@ -198,6 +229,8 @@ class Menu():
         for btn in self.buttons:
            btn['btn'].add(btn['index'])
         running_challenge = None
+        logger.info("Warming up camera")
+        self.camera_service.open()
         
         # While loop to manage touch screen inputs
         with ControllerResource() as self.joystick:
@@ -237,5 +270,15 @@ class Menu():
 
 
 if __name__ == "__main__":
-    menu = Menu(timeout=int(arguments['--timeout']))
-    menu.run()
+    menu = Menu(
+        timeout=int(arguments['--timeout']),
+        detection_workers=int(arguments['--detection-workers']),
+        debug_images=arguments['--debug-images'],
+        sessions=arguments['--sessions']
+    )
+    try:
+        menu.run()
+    finally:
+        menu.camera_service.close()
+        if menu.detection_pool is not None:
+            menu.detection_pool.close()
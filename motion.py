@@ -0,0 +1,100 @@
+# Timed manoeuvres that run on a timer thread instead of sleeping in the
+# caller, so the stream processor keeps processing frames while the robot
+# turns or brakes, and can cut a manoeuvre short
+import logging
+import threading
+import time
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+class MotionPrimitives(object):
+    """Mixin for drives: pulses and sequences of motor settings.
+
+    A step is (forward, turn, duration) with forward and turn as for
+    move(): the motors are set, and the next step starts duration
+    seconds later from a timer thread. sequence() and pulse() return
+    straight away. Starting one cancels whatever was running, and so
+    does move(), so the next decision the vision code makes always
+    wins. `busy` is true until the last step's time is up, which lets
+    a caller leave a manoeuvre to finish rather than restart it.
+
+    The class mixed into provides _set_motors(forward, turn). Every call
+    to it is made holding `motion_lock`, so the caller and the timer
+    thread never talk to the motor controller at the same time.
+    `command` is the (forward, turn) it was last called with."""
+
+    def __init__(self):
+        self.motion_lock = threading.RLock()
+        self._motion = None
+        self._timer = None
+        self.command = (0, 0)
+
+    @property
+    def busy(self):
+        return self._motion is not None
+
+    def move(self, forward, turn):
+        with self.motion_lock:
+            self.cancel()
+            self.command = (forward, turn)
+            self._set_motors(forward, turn)
+
+    def cancel(self):
+        """Stop the running manoeuvre where it is, leaving the motors as
+        they are"""
+        with self.motion_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._motion = None
+
+    def sequence(self, steps):
+        with self.motion_lock:
+            self.cancel()
+            # the timer of a cancelled manoeuvre may already be waiting
+            # for the lock, this tells it it's been replaced
+            self._motion = object()
+            self._step(self._motion, list(steps))
+
+    def pulse(self, forward, turn, duration, settle=0):
+        """Drive for duration seconds, then stop and stay busy for settle
+        seconds more"""
+        self.sequence([(forward, turn, duration), (0, 0, settle)])
+
+    def _step(self, motion, steps):
+        with self.motion_lock:
+            if motion is not self._motion:
+                return
+            if not steps:
+                self._timer = None
+                self._motion = None
+                return
+            forward, turn, duration = steps[0]
+            self.command = (forward, turn)
+            self._set_motors(forward, turn)
+            self._timer = threading.Timer(
+                duration, self._step, (motion, steps[1:])
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+
+class ReplayDrive(MotionPrimitives):
+    """Stands in for DriveTrain off the robot, for replay.py and
+    benchmark.py, and just logs what the processor asked the motors to
+    do"""
+
+    def __init__(self):
+        super(ReplayDrive, self).__init__()
+        self.should_normalise_motor_speed = True
+        self.last_move_time = 0
+        self.moves = 0
+
+    def _set_motors(self, forward, turn):
+        logger.debug('move %.2f, %.2f', forward, turn)
+        self.last_move_time = time.time()
+        self.moves += 1
+
+    def stop(self):
+        self.cancel()
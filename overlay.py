@@ -0,0 +1,71 @@
+# Annotations drawn over the touchscreen preview: fonts are loaded once
+# and rendered text is kept, so the same label costs a blit per frame
+# rather than a font load and a render
+from collections import OrderedDict
+
+import pygame
+
+
+class Overlay(object):
+    """Labels, crosshairs and boxes queued up during a frame and drawn
+    onto the screen together by draw().
+
+    Positions are screen coordinates. Fonts are kept by size, and the
+    last LABELS label surfaces rendered are kept by text, size and
+    colour, so labels that change every frame, like a blob's area, don't
+    pile up."""
+
+    LABELS = 64
+    WHITE = (250, 250, 250)
+    TARGET = (255, 0, 0)
+
+    def __init__(self):
+        self._fonts = {}
+        self._labels = OrderedDict()
+        self._items = []
+
+    def font(self, size):
+        font = self._fonts.get(size)
+        if font is None:
+            font = self._fonts[size] = pygame.font.Font(None, size)
+        return font
+
+    def render(self, text, size=24, colour=WHITE):
+        """The surface of a label, rendered the first time it's asked for"""
+        key = (text, size, colour)
+        surface = self._labels.pop(key, None)
+        if surface is None:
+            surface = self.font(size).render(text, 1, colour)
+            if len(self._labels) >= self.LABELS:
+                self._labels.popitem(last=False)
+        # most recently used last
+        self._labels[key] = surface
+        return surface
+
+    def label(self, text, position, size=24, colour=WHITE):
+        self._items.append(('label', (str(text), position, size, colour)))
+
+    def crosshair(self, position, colour=TARGET, size=8):
+        """Where a target is, in place of moving the mouse pointer there"""
+        self._items.append(('crosshair', (position, colour, size)))
+
+    def box(self, rect, colour=TARGET):
+        self._items.append(('box', (rect, colour)))
+
+    def clear(self):
+        self._items = []
+
+    def draw(self, screen):
+        """Draw everything queued since the last draw()"""
+        for kind, args in self._items:
+            if kind == 'label':
+                text, position, size, colour = args
+                screen.blit(self.render(text, size, colour), position)
+            elif kind == 'crosshair':
+                (x, y), colour, size = args
+                pygame.draw.line(screen, colour, (x - size, y), (x + size, y))
+                pygame.draw.line(screen, colour, (x, y - size), (x, y + size))
+            else:
+                rect, colour = args
+                pygame.draw.rect(screen, colour, rect, 1)
+        self._items = []
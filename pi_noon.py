@@ -1,35 +1,56 @@
 from img_base_class import *
+from frame_bus import FrameBus, PreviewSubscriber
+from governor import Governor
+from blobs import PyramidSearch
+from denoise import Denoise
+from balloon_model import BalloonModel
+from floor_edge import FloorEdge
+from debug_capture import capture_for
 import random
 import cv2.aruco as aruco
 from approxeng.input.selectbinder import ControllerResource
 
 # Image stream processing thread
-class StreamProcessor(threading.Thread):
-    def __init__(self, screen=None, camera=None, drive=None):
-        super(StreamProcessor, self).__init__()
-        self.camera = camera
-        self.image_width, self.image_height = self.camera.resolution
-        self.image_centre_x = self.image_width / 2.0
-        self.image_centre_y = self.image_height / 2.0
-        self.drive = drive
+class StreamProcessor(BaseStreamProcessor):
+    SCALED = {
+        'MIN_BALLOON_SIZE': 2, 'TURN_AREA': 2, 'EDGE_ROWS': 1,
+        'BACK_AWAY_START': 2, 'BACK_AWAY_STOP': 2,
+        'PYRAMID_2X_AREA': 2, 'PYRAMID_4X_AREA': 2,
+    }
+
+    def __init__(self, screen=None, camera=None, drive=None, roi=None,
+                 frames=None, governor=None, denoise='none', capture=None,
+                 preview=None):
+        super(StreamProcessor, self).__init__(
+            screen=screen, camera=camera, drive=drive, roi=roi, frames=frames,
+            governor=governor
+        )
         self.drive.should_normalise_motor_speed = False
-        self.screen = screen
-        self.stream = picamera.array.PiRGBArray(camera)
-        self.event = threading.Event()
-        self.terminated = False
         self.DRIVING = True
         self.TURN_TIME = 0.1
         self.TURN_SPEED = 1
         self.SETTLE_TIME = 0.05
         self.MIN_BALLOON_SIZE = 50
         self.TURN_AREA = 5000  #6000 turns right at edge, 9000 too high
-        self.TURN_HEIGHT = 18
+        self.EDGE_ROWS = 36  # rows of floor ahead before we call it the edge
         self.BACK_AWAY_START = 2000
         self.BACK_AWAY_STOP = 1500
         self.back_away = False
         self.edge = False
         self.BLUR = 3
+        self.denoise = Denoise(denoise, self.BLUR)
+        self.floor_edge = FloorEdge(self.workspace)
+        # saves frames for debugging, if it's not None
+        self.capture = capture
+        # PreviewSubscriber of the camera image, drawn with the masks
+        self.preview = preview
+        # what the balloon looks like is learned while calibrating, and
+        # kept for the next bout. Until then it's anything in these limits
         self.colour_limits = ((0, 50, 70), (180, 250, 230))
+        self.MODEL_PATH = 'balloon.npy'
+        self.model = BalloonModel()
+        self.model.load(self.MODEL_PATH)
+        self.was_calibrating = False
         self.FLOOR_LIMITS  =  ((100, 150, 80), (130, 255, 220))#<red, yellow>  ((85, 190, 80), (115, 255, 220))
         self.calibrating = False
         self.tracking = False
@@ -52,28 +73,19 @@ class StreamProcessor(threading.Thread):
         self.END_TIME = self.START_TIME + self.TIMEOUT
         self.found = False
         self.finished = False
+        # balloon areas from which the balloon is found in a frame
+        # downsampled 2x or 4x first
+        self.PYRAMID_2X_AREA = 800
+        self.PYRAMID_4X_AREA = 3000
+        self.balloon_search = PyramidSearch(
+            self.segment_balloon, self.select_balloon, self.pyramid_levels()
+        )
         self.i = 0
         logger.info("setup complete, looking")
-        time.sleep(1)
         self.endtime=time.time()
         self.start()
 
-    def run(self):
-        # This method runs in a separate thread
-        while not self.terminated:
-            # Wait for an image to be written to the stream  
-            if self.event.wait(1):
-                try:
-                    # Read the image and do some processing on it
-                    self.stream.seek(0)
-                    self.process_image(self.stream.array, self.screen)
-                finally:
-                    # Reset the stream and event
-                    self.stream.seek(0)
-                    self.stream.truncate()
-                    self.event.clear()
-
-    def threshold_image(self, image, limits):
+    def threshold_image(self, image, limits, dst=None):
         '''function to find what parts of an image liue within limits.
         returns the parts of the original image within the limits, and the mask'''
         hsv_lower, hsv_upper = limits
@@ -81,100 +93,129 @@ class StreamProcessor(threading.Thread):
         mask = cv2.inRange(
             image,
             numpy.array(hsv_lower),
-            numpy.array(hsv_upper)
+            numpy.array(hsv_upper),
+            dst=dst
         )
         return mask
 
+    def rescale(self, governor):
+        super(StreamProcessor, self).rescale(governor)
+        self.balloon_search.levels = self.pyramid_levels()
+
+    def pyramid_levels(self):
+        return (
+            (0, 1), (self.PYRAMID_2X_AREA, 2), (self.PYRAMID_4X_AREA, 4)
+        )
+
+    def segment_balloon(self, image, factor):
+        workspace = self.workspace
+        mask = workspace.buffer('balloon mask %d' % factor, image.shape[:2])
+        if self.model.trained:
+            mask = self.model.back_project(
+                image, dst=mask,
+                bright=workspace.buffer('balloon bright %d' % factor, image.shape[:2])
+            )
+        else:
+            mask = self.threshold_image(image, self.colour_limits, dst=mask)
+        return self.denoise.mask(mask) if factor == 1 else mask
+
+    def select_balloon(self, blobs):
+        return blobs.biggest(min_size=1)
+
+    def find_balloon(self, image):
+        '''coordinates and size of the largest blob of balloon colour, searching
+        coarse to fine when the last balloon seen was big'''
+        search = self.balloon_search
+        blobs, biggest, x, y = search.search(image)
+        if biggest is None:
+            balloon = -1, -1, 1
+        else:
+            balloon = (
+                x + int(blobs.centroid_x[biggest]),
+                y + int(blobs.centroid_y[biggest]),
+                blobs.area[biggest]
+            )
+        search.choose(balloon[2] if balloon[2] > self.MIN_BALLOON_SIZE else None)
+        return balloon
+
     def turn_around(self):
         print "turning around"
         if random.choice([True, False]):
-            self.drive.move(self.TURN_AROUND_SPEED, 0)
+            self.drive.pulse(self.TURN_AROUND_SPEED, 0, self.TURN_AROUND_TIME)
         else:
-            self.drive.move(-self.TURN_AROUND_SPEED, 0)
-        time.sleep(self.TURN_AROUND_TIME)
-        self.drive.move(0, 0)
+            self.drive.pulse(-self.TURN_AROUND_SPEED, 0, self.TURN_AROUND_TIME)
 
-    def get_limits(self, image, sigmas):
-        """function to use the mean and standard deviation of an images
-        channels in the centre of the image to create suggested threshold
-        limits based on number of 'sigmas' (usually less than three).
-        returns a tuple of tuples ((low1, low2, low3),(upp1, upp2, upp3))"""
+    def centre_mask(self, image):
+        """mask of the circle in the centre of the image the balloon is
+        held in while calibrating"""
         h, w = image.shape[:2]
-        mask_radius = min(h, w)/2
-        mask = numpy.zeros(image.shape[:2], numpy.uint8)
-        cv2.circle(mask, (w/2, h/2), mask_radius, 255, -1)
-        mean, stddev = cv2.meanStdDev(image, mask=mask)
-        lower = mean - sigmas * stddev
-        upper = mean + sigmas * stddev
-        return ((lower[0][0], lower[1][0], lower[2][0]), (upper[0][0], upper[1][0], upper[2][0]))
+        mask = self.workspace.buffer('centre', (h, w))
+        mask[:] = 0
+        cv2.circle(mask, (w // 2, h // 2), min(h, w) // 2, 255, -1)
+        return mask
 
-    def seek(self):
-        self.drive.move(self.TURN_SPEED, 0)
-        time.sleep(self.TURN_TIME)
-        self.drive.move(0,0)
-        time.sleep(self.SETTLE_TIME)
+    def calibrate(self, image):
+        """learn the balloon's colours from the centre of the image, from
+        scratch at the start of each calibration, and save them at the end"""
+        if self.calibrating:
+            if not self.was_calibrating:
+                self.model.reset()
+            self.model.learn(image, self.centre_mask(image))
+        elif self.was_calibrating and self.model.trained:
+            self.model.save(self.MODEL_PATH)
+        self.was_calibrating = self.calibrating
+
+    def seek(self, direction=1):
+        self.drive.pulse(
+            direction * self.TURN_SPEED, 0, self.TURN_TIME, self.SETTLE_TIME
+        )
     
     def show_cal_label(self, screen):
-        font = pygame.font.Font(None, 60)
-        label = font.render(str("Calibrating"), 1, (255,255,255))
-        screen.blit(label, (10, 200))
+        self.overlay.label("Calibrating", (10, 200), 60, (255, 255, 255))
 
     def show_tracking_label(self, screen):
-        font = pygame.font.Font(None, 60)
-        label = font.render(str("Tracking"), 1, (255,255,255))
-        screen.blit(label, (10, 200))
-
-    def find_largest_contour(self,image):
-        '''takes a binary image and returns coordinates and size of largest contour'''
-        contourimage, contours, hierarchy = cv2.findContours(
-            image, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE
-        )
-        # Go through each contour
-        found_area = 1
-        found_x = -1
-        found_y = -1
-        biggest_contour = None
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            area = cv2.contourArea(contour)
-            aspect_ratio = float(h)/w
-            if found_area < area:
-                found_area = area
-                M = cv2.moments(contour)
-                found_x = int(M['m10']/M['m00'])
-                found_y = int(M['m01']/M['m00'])
-                biggest_contour = contour
-        return found_x, found_y, found_area
+        self.overlay.label("Tracking", (10, 200), 60, (255, 255, 255))
 
     def process_image(self, image, screen):
         screen = pygame.display.get_surface()
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-        ball_image = image[self.BALL_CROP_HEIGHT:self.image_height, (self.image_centre_x - self.BALL_CROP_WIDTH/2):(self.image_centre_x + self.BALL_CROP_WIDTH/2)]
-        floor_image = image[self.FLOOR_CROP_START:self.FLOOR_CROP_HEIGHT, (self.image_centre_x - self.FLOOR_CROP_WIDTH/2):(self.image_centre_x + self.FLOOR_CROP_WIDTH/2)]
-        image=image[self.FLOOR_CROP_START:self.image_height, 0:self.image_width]
+        # the camera delivers everything below FLOOR_CROP_START, the ball
+        # and floor regions are views into it
+        camera_image = image
+        image = cv2.cvtColor(
+            self.denoise.image(image, self.workspace), cv2.COLOR_RGB2HSV,
+            dst=self.workspace.like('hsv', image)
+        )
+        ball_image = self.roi.view(image, 'ball')
+        floor_image = self.roi.view(image, 'floor')
         #for floor calibration:       print cv2.meanStdDev(floor_image)
         # Our operations on the frame come here
-        screenimage = cv2.cvtColor(image, cv2.COLOR_HSV2BGR)
-        frame = pygame.surfarray.make_surface(cv2.flip(screenimage, 1))
-        screen.fill([0, 0, 0])
-        screen.blit(frame, (0, 0))
+        # the camera image itself is got ready by the preview subscriber,
+        # just clear the label area
+        screen.fill([0, 0, 0], (0, 200, 240, 50))
         if self.calibrating:
             self.show_cal_label(screen)
-            self.colour_limits = self.get_limits(ball_image, 1.5)
+        self.calibrate(ball_image)
         if self.tracking:
             self.show_tracking_label(screen)
-        ball_range = self.threshold_image(ball_image, self.colour_limits)
-        floor_range =  self.threshold_image(floor_image, self.FLOOR_LIMITS)
+        balloon_x, balloon_y, balloon_a = self.find_balloon(ball_image)
+        ball_range = self.balloon_search.mask
+        floor_range =  self.denoise.mask(self.threshold_image(
+            floor_image, self.FLOOR_LIMITS,
+            dst=self.workspace.buffer('floor mask', floor_image.shape[:2])
+        ))
+        self.frame_info.stage('search')
         # We want to extract the 'Hue', or colour, from the image. The 'inRange'
-        frame = pygame.surfarray.make_surface(cv2.flip(floor_range, 1))
-        screen.blit(frame, (self.image_height-self.FLOOR_CROP_START, 0))
-        frame = pygame.surfarray.make_surface(cv2.flip(ball_range, 1))
-        screen.blit(frame, (self.image_height-self.FLOOR_CROP_START + self.FLOOR_CROP_HEIGHT, 0))
+        if self.preview is not None:
+            self.preview.draw(screen)
+        frame = mirrored_surface(self.workspace, 'floor', floor_range)
+        screen.blit(frame, (self.image_height, 0))
+        frame = mirrored_surface(self.workspace, 'ball', ball_range)
+        screen.blit(frame, (self.image_height + self.FLOOR_CROP_HEIGHT, 0))
+        if balloon_x >= 0:
+            self.overlay.crosshair((balloon_y+self.FLOOR_CROP_HEIGHT-self.FLOOR_CROP_START, self.BALL_CROP_WIDTH - balloon_x))
+        self.overlay.draw(screen)
         pygame.display.update()
-        # Find the contours
-        balloon_x, balloon_y, balloon_a = self.find_largest_contour(ball_range)
-        if balloon_a is not None:
-            pygame.mouse.set_pos(balloon_y+self.FLOOR_CROP_HEIGHT-self.FLOOR_CROP_START, self.BALL_CROP_WIDTH - balloon_x)
+        t_error = None
         if balloon_a > self.MIN_BALLOON_SIZE:
                 #opponent is disrupting countour shape, making it concave
                 print ("found balloon: position %d, %d, area %d" % (balloon_x, balloon_y, balloon_a))
@@ -191,51 +232,89 @@ class StreamProcessor(threading.Thread):
                     self.back_away = False
                     if self.DRIVING and self.tracking:
                         self.drive.move(turn, self.STRAIGHT_SPEED)
+        elif self.drive.busy:
+            # a turn is under way and nothing's worth cutting it short
+            # for, the balloon would be
+            self.found = False
         else:
             self.edge = False
             self.back_away = False
             self.found = False
-            floor_x, floor_y, floor_a = self.find_largest_contour(floor_range)
-            if floor_y < self.TURN_HEIGHT:
+            self.floor_edge.update(floor_range)
+            ahead = self.floor_edge.ahead()
+            # head for whichever way there's most floor
+            floor_x = self.floor_edge.heading()
+            t_error = (self.image_centre_x - floor_x) / self.image_centre_x
+            if self.floor_edge.sectors.max() < self.EDGE_ROWS:
+                self.edge = True
+                print ("no opponent found and edge all round, turning around")
+                if self.DRIVING and self.tracking:
+                    self.turn_around()
+            elif ahead < self.EDGE_ROWS:
                 self.edge = True
-                print ("no opponent found and close to edge, turning %s" % (floor_y))
+                print ("no opponent found and close to edge, turning %s" % (ahead))
                 if self.DRIVING and self.tracking:
-                    self.seek()
+                    self.seek(1 if t_error >= 0 else -1)
             else:
                 self.edge = False
                 print "no opponent found, ambling"
-                t_error = (self.image_centre_x - floor_x) / self.image_centre_x
                 turn = self.TURN_P * t_error
                 if self.DRIVING and self.tracking:
-                    #turn around one time in 5. is there a better way to do this?
-                    if random.choice([True, False, False, False, False]):
-                        self.turn_around()
-                    else:
-                        self.drive.move(turn, self.STRAIGHT_SPEED)
+                    self.drive.move(turn, self.STRAIGHT_SPEED)
         if self.tracking:
-            image = cv2.cvtColor(image, cv2.COLOR_HSV2RGB)
-            if self.found:
-                img_name = str(self.i) + "Fimg.jpg"
-            else:
-            #if self.edge:
-                #cv2.imwrite(str(self.i) + "imrange.jpg", imrange)
-                img_name = str(self.i) + "NFimg.jpg"
-            #filesave for debugging: 
-            #cv2.imwrite(img_name, image)
+            state = (self.found, self.edge, self.back_away)
+            if self.capture is not None and self.capture.due(state):
+                if self.found:
+                    img_name = str(self.i) + "Fimg.jpg"
+                else:
+                    img_name = str(self.i) + "NFimg.jpg"
+                self.capture.put(img_name, camera_image, {
+                    'found': self.found, 'edge': self.edge,
+                    'back_away': self.back_away,
+                    'balloon': (balloon_x, balloon_y, balloon_a),
+                    't_error': t_error, 'command': self.drive.command,
+                })
             self.i += 1
 
 
 class PiNoon(BaseChallenge):
     """Pi Noon challenge class"""
 
-    def __init__(self, timeout=120, screen=None, joystick=None):
-        self.image_width = 160  # Camera image width
-        self.image_height = 128  # Camera image height
+    # Camera image size and the part of it captured: the top 10 rows are
+    # never used, the rows above 55 are floor close to the robot and the
+    # rest is where balloons appear
+    ROI = RegionOfInterest(
+        (160, 128), (0, 10, 160, 118),
+        regions={
+            'floor': (0, 10, 160, 45),
+            'ball': (0, 55, 160, 73),
+        }
+    )
+    # (scale, framerate) levels the governor can step down through. The
+    # image is small already, and the frame bus can't be resized under
+    # its subscribers, so only the framerate comes down
+    GOVERNOR_LEVELS = ((1.0, 40), (1.0, 30), (1.0, 20))
+    # see Denoise.METHODS
+    DENOISE = 'none'
+    # frames saved for debugging, see debug_capture.capture_for
+    DEBUG_IMAGES = 'off'
+
+    def __init__(self, timeout=120, screen=None, joystick=None,
+                 camera_service=None, debug_images=None, sessions=None):
         self.frame_rate = 40  # Camera image capture frame rate
+        self.roi = self.ROI
         self.screen = screen
         time.sleep(0.01)
         self.joystick=joystick
-        super(PiNoon, self).__init__(name='PiNoon', timeout=timeout, logger=logger)
+        if debug_images is not None:
+            self.DEBUG_IMAGES = debug_images
+        # directory to record sessions to instead of image files
+        self.sessions = sessions
+        self.capture = None
+        super(PiNoon, self).__init__(
+            name='PiNoon', timeout=timeout, logger=logger,
+            camera_service=camera_service
+        )
 
     def joystick_handler(self, button):
         if button['r1']:
@@ -257,22 +336,37 @@ class PiNoon(BaseChallenge):
         # Startup sequence
         logger.info('Setting up camera')
         screen = pygame.display.get_surface()
-        self.camera = picamera.PiCamera()
-        self.camera.resolution = (self.image_width, self.image_height)
-        self.camera.framerate = self.frame_rate
-        self.camera.iso = 800
-        self.camera.awb_mode = 'off'
-        self.camera.awb_gains = (1.149, 2.193)
-        self.camera.shutter_speed = 12000
+        self.camera = self.lease_camera(
+            self.roi,
+            self.frame_rate,
+            iso=800,
+            awb_mode='off',
+            awb_gains=(1.149, 2.193),
+            shutter_speed=12000
+        )
+        # steps resolution and framerate down if processing can't keep up
+        self.governor = Governor(self.roi, self.GOVERNOR_LEVELS)
+        # frames are shared between the controller and the preview, so
+        # drawing the preview doesn't hold up control
+        self.frame_bus = FrameBus(self.camera)
+        self.capture = capture_for(
+            self.DEBUG_IMAGES, sessions=self.sessions, name=self.name
+        )
+        self.preview = PreviewSubscriber(self.frame_bus)
         logger.info('Setup the stream processing thread')
         # TODO: Remove dependency on drivetrain from StreamProcessor
         self.processor = StreamProcessor(
             screen=self.screen,
             camera=self.camera,
             drive=self.drive,
+            roi=self.roi,
+            frames=self.frame_bus.subscribe('controller'),
+            governor=self.governor,
+            denoise=self.DENOISE,
+            capture=self.capture,
+            preview=self.preview
         )
-        logger.info('Wait ...')
-        time.sleep(2)
+        self.preview.start()
         logger.info('Setting up image capture thread')
         self.image_capture_thread = ImageCapture(
             camera=self.camera,
@@ -299,9 +393,13 @@ class PiNoon(BaseChallenge):
             self.image_capture_thread.join()
             self.processor.terminated = True
             self.processor.join()
-            #release camera
-            self.camera.close()
-            self.camera = None
+            self.preview.join()
+            if self.capture is not None:
+                self.capture.close()
+                self.capture.log_stats()
+                self.capture = None
+            self.log_latency()
+            self.release_camera()
             self.logger.info("stopping drive")
             self.drive.stop()
             pygame.mouse.set_visible(False)
@@ -1,27 +1,42 @@
 #!/usr/bin/env python
 # coding: Latin
 
-import json
-from my_button import MyScale
+try:
+    import sgc
+    from my_button import MyScale
+except ImportError:
+    # the touchscreen widgets are Python 2 only, the stream processor
+    # runs without them off the robot, e.g. in benchmark.py
+    sgc = MyScale = None
 # Load all standard tools for image processing challenges
 from img_base_class import *
+from governor import Governor
+from colour_lut import ColourClassifier
+from blobs import Blobs, PyramidSearch
+from ball_tracker import BallTracker
+from arena_map import ArenaMap
+from threshold_profiles import ThresholdProfiles, compile_bounds
+from denoise import Denoise
 
 
 # Image stream processing thread
-class StreamProcessor(threading.Thread):
-    def __init__(self, screen=None, camera=None, drive=None, colour="any"):
-        super(StreamProcessor, self).__init__()
-        self.camera = camera
-        image_width, image_height = self.camera.resolution
-        self.image_centre_x = image_width / 2.0
-        self.image_centre_y = image_height / 2.0
-        self.drive = drive
-        self.screen = screen
-        self.stream = picamera.array.PiRGBArray(camera)
-        self.event = threading.Event()
-        self.terminated = False
+class StreamProcessor(BaseStreamProcessor):
+    SCALED = {
+        'MAX_AREA': 2, 'MIN_CONTOUR_AREA': 2, 'BACK_OFF_AREA': 2,
+        'AREA_P': -2, 'AREA_D': -2,
+        'PYRAMID_2X_AREA': 2, 'PYRAMID_4X_AREA': 2,
+    }
+    PER_FRAME = ('AREA_D', 'TURN_D')
+
+    def __init__(self, screen=None, camera=None, drive=None, colour="any",
+                 roi=None, governor=None, denoise='median'):
+        super(StreamProcessor, self).__init__(
+            screen=screen, camera=camera, drive=drive, roi=roi,
+            governor=governor
+        )
         self.MAX_AREA = 4000  # Largest target to move towards
         self.MIN_CONTOUR_AREA = 3
+        self.denoise = Denoise(denoise, 5)
         self._colour = colour
         self.found = False
         self.retreated = False
@@ -33,16 +48,40 @@ class StreamProcessor(threading.Thread):
         self.AREA_D = 0.0003
         self.TURN_P = 0.7
         self.TURN_D = 0.3
-        self.colour_bounds = json.load(open('rainbow.json'))
+        # tuned from the menu on the UI thread while frames are processed
+        self.profiles = ThresholdProfiles('rainbow.json')
+        self.DEFAULT_BOUNDS = compile_bounds((40, 0, 0), (180, 255, 255))
+        self.classifier = ColourClassifier(self.profiles.bounds())
+        self.classifier_version = self.profiles.version
+        self.diagnostics.probe('area', self.probe_area)
+        self.diagnostics.probe('fill', self.probe_fill)
+        self.diagnostics.probe('mean_hsv', self.probe_mean_hsv)
+        self.tracker = BallTracker((self.image_width, self.image_height))
+        self.tracked_colour = None
+        # blob areas from which a ball is found in a frame downsampled 2x
+        # or 4x first
+        self.PYRAMID_2X_AREA = 600
+        self.PYRAMID_4X_AREA = 2400
+        self.search = PyramidSearch(
+            self.segment, self.select_ball, self.pyramid_levels()
+        )
         self.hsv_lower = (0, 0, 0)
         self.hsv_upper = (0, 0, 0)
         self.BACK_OFF_AREA = 1000
         self.BACK_OFF_SPEED = -0.25
         self.FAST_SEARCH_TURN = 0.7
+        # one slower turn through a full circle maps every ball before
+        # the first is approached, then the robot turns to each in turn
+        self.arena = ArenaMap()
+        self.MAPPING_TURN = 0.4
+        self.HEADING_P = 0.015  # turn per degree off the mapped bearing
+        self.SURVEY_INTERVAL = 5  # frames between map updates while mapping
+        self.MAPPED_SURVEY_INTERVAL = 30  # and once it's mapped
+        self.frames_since_survey = 0
+        # frames the target's not been seen while the map has it in view
+        self.misses_at_bearing = 0
         self.DRIVING = True
         self.tracking = False
-        # Why the one second sleep?
-        time.sleep(1)
         self.start()
 
     @property
@@ -54,92 +93,211 @@ class StreamProcessor(threading.Thread):
     def colour(self, colour):
         self._colour = colour
 
-    def run(self):
-        # This method runs in a separate thread
-        while not self.terminated:
-            # Wait for an image to be written to the stream
-            if self.event.wait(1):
-                try:
-                    # Read the image and do some processing on it
-                    self.stream.seek(0)
-                    self.process_image(self.stream.array, self.screen)
-                finally:
-                    # Reset the stream and event
-                    self.stream.seek(0)
-                    self.stream.truncate()
-                    self.event.clear()
+    def rescale(self, governor):
+        super(StreamProcessor, self).rescale(governor)
+        # the track is in pixels and frames of the old level
+        self.tracker = BallTracker((self.image_width, self.image_height))
+        self.search.levels = self.pyramid_levels()
+        self.search.choose(None)
 
-    # Image processing function
-    def process_image(self, image, screen):
-        screen = pygame.display.get_surface()
-        # crop image to speed up processing and avoid false positives
-        image = image[80:180, 0:320]
-        img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        if not self.menu:
-            frame = pygame.surfarray.make_surface(cv2.flip(img, 1))
-            screen.fill([0, 0, 0])
-            font = pygame.font.Font(None, 24)
-            screen.blit(frame, (0, 0))
-        image = cv2.medianBlur(image, 5)
+    def pyramid_levels(self):
+        return (
+            (0, 1), (self.PYRAMID_2X_AREA, 2), (self.PYRAMID_4X_AREA, 4)
+        )
+
+    def segment(self, image, factor):
+        """Mask of the target colour in a BGR image. A downsampled image
+        is smoothed enough by the downsampling to skip denoising"""
+        workspace = self.workspace
+        if factor == 1:
+            image = self.denoise.image(image, workspace)
+        mask = workspace.buffer('mask %d' % factor, image.shape[:2])
+        classifier = self.classifier
+        if self.colour in classifier.labels:
+            # every ball colour is labelled in one table lookup, then the
+            # target colour is picked out of the labels
+            labels = classifier.classify(image)
+            mask = classifier.mask(labels, self.colour, dst=mask)
+            return self.denoise.mask(mask) if factor == 1 else mask
         # Convert the image from 'BGR' to HSV colour space
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        image = cv2.cvtColor(
+            image, cv2.COLOR_RGB2HSV, dst=workspace.like('hsv', image)
+        )
         # We want to extract the 'Hue', or colour, from the image. The 'inRange'
         # method will extract the colour we are interested in (between 0 and 180)
-        default_colour_bounds = ((40, 0, 0), (180, 255, 255))
-        hsv_lower, hsv_upper = self.colour_bounds.get(
-            self.colour, default_colour_bounds
+        hsv_lower, hsv_upper = self.profiles.get(
+            self.colour, self.DEFAULT_BOUNDS
         )
-        imrange = cv2.inRange(
-            image,
-            numpy.array(hsv_lower),
-            numpy.array(hsv_upper)
+        mask = cv2.inRange(image, hsv_lower, hsv_upper, dst=mask)
+        return self.denoise.mask(mask) if factor == 1 else mask
+
+    def survey(self, image):
+        """Put every ball colour in view on the arena map"""
+        workspace = self.workspace
+        labels = self.classifier.classify(self.denoise.image(image, workspace))
+        mask = workspace.buffer('survey mask', labels.shape)
+        blob_labels = workspace.buffer('survey labels', labels.shape, numpy.int32)
+        frame_area = float(self.image_width * self.image_height)
+        for colour in self.classifier.names[1:]:
+            blobs = Blobs(
+                self.denoise.mask(self.classifier.mask(labels, colour, dst=mask)),
+                labels=blob_labels
+            )
+            index = self.select_ball(blobs)
+            if index is not None:
+                self.arena.see(
+                    colour,
+                    (self.image_centre_x - blobs.box_centre_x[index]) /
+                    self.image_width,
+                    blobs.box_area[index] / frame_area
+                )
+        self.frames_since_survey = 0
+
+    def move(self, turn, forward):
+        """Drive, keeping the arena map's heading up to date"""
+        self.drive.move(turn, forward)
+        self.arena.turn(turn)
+
+    def select_ball(self, blobs):
+        """The biggest roughly square blob"""
+        return blobs.biggest(
+            blobs.box_area, min_size=self.MIN_CONTOUR_AREA,
+            min_aspect=0.5, max_aspect=2
         )
-        if not self.menu:
-            frame = pygame.surfarray.make_surface(cv2.flip(imrange, 1))
-            screen.blit(frame, (100, 0))
-            pygame.display.update()
-        # Find the contours
-        contourimage, contours, hierarchy = cv2.findContours(
-            imrange, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE
+
+    def probe_area(self, probes):
+        """Pixel area of the ball"""
+        if probes['index'] is None:
+            return None
+        return int(probes['blobs'].area[probes['index']])
+
+    def probe_fill(self, probes):
+        """Share of the ball's bounding box in the target colour"""
+        if probes['index'] is None:
+            return None
+        return (float(probes['area']) /
+                probes['blobs'].box_area[probes['index']])
+
+    def probe_mean_hsv(self, probes):
+        """Mean HSV of the target colour in the ball's bounding box, to
+        tune its bounds by"""
+        index = probes['index']
+        if index is None:
+            return None
+        blobs = probes['blobs']
+        x0, y0 = probes['blob_origin']
+        x0 += blobs.x[index]
+        y0 += blobs.y[index]
+        box = probes['image'][
+            y0:y0 + blobs.height[index], x0:x0 + blobs.width[index]
+        ]
+        hsv = cv2.cvtColor(box, cv2.COLOR_RGB2HSV)
+        lower, upper = self.profiles.get(self.colour, self.DEFAULT_BOUNDS)
+        mean = cv2.mean(hsv, mask=cv2.inRange(hsv, lower, upper))
+        return tuple(int(channel) for channel in mean[:3])
+
+    def show(self, probes):
+        """Debug view on the touchscreen: the camera image, the mask
+        searched and the ball's area"""
+        if self.menu:
+            return
+        screen = pygame.display.get_surface()
+        # the camera only delivers the band the balls can appear in
+        image = probes['image']
+        img = cv2.cvtColor(
+            image, cv2.COLOR_BGR2RGB, dst=self.workspace.like('rgb', image)
         )
+        frame = mirrored_surface(self.workspace, 'preview', img)
+        screen.fill([0, 0, 0])
+        screen.blit(frame, (0, 0))
+        x0, y0, x1, y1 = probes['window']
+        frame = mirrored_surface(self.workspace, 'mask', probes['mask'])
+        screen.blit(frame, (100 + y0, self.image_width - x1))
+        index = probes['index']
+        if index is not None:
+            # the preview is mirrored and turned on its side
+            blobs = probes['blobs']
+            blob_x, blob_y = probes['blob_origin']
+            found_x, found_y = probes['found']
+            self.overlay.crosshair((found_y, self.image_width - found_x))
+            self.overlay.box((
+                blob_y + blobs.y[index],
+                self.image_width - blob_x - blobs.x[index] - blobs.width[index],
+                blobs.height[index], blobs.width[index]
+            ))
+            # skate wheel at 100mm has area = 7000,
+            # from centre of course is 180, far corner is 5
+            self.overlay.label(probes['area'], (10, 30))
+        self.overlay.draw(screen)
+        pygame.display.update()
 
-        # Go through each contour
-        found_area = -1
-        found_x = -1
-        found_y = -1
-        biggest_contour = None
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            cx = x + (w / 2)
-            cy = y + (h / 2)
-            area = w * h
-            aspect_ratio = float(h)/w
-            if found_area < area and aspect_ratio < 2 and aspect_ratio > 0.5:
-                found_area = area
-                found_x = cx
-                found_y = cy
-                biggest_contour = contour
-        if found_area > self.MIN_CONTOUR_AREA:
-            mask = numpy.zeros(image.shape[:2], dtype="uint8")
-            cv2.drawContours(mask, [biggest_contour], -1, 255, -1)
-            mask = cv2.erode(mask, None, iterations=2)
-            mean = cv2.mean(image, mask=mask)[:3]
-            #print mean
-            ball = [found_x, found_y, found_area]
+    # Image processing function
+    def process_image(self, image, screen):
+        if self.profiles.version != self.classifier_version:
+            # the bounds have been changed from the menu
+            self.classifier_version = self.profiles.version
+            self.classifier = ColourClassifier(self.profiles.bounds())
+        if self.colour != self.tracked_colour:
+            self.tracker.reset()
+            self.search.choose(None)
+            self.tracked_colour = self.colour
+        # once the ball has been found, only search the window the
+        # tracker predicts it's in
+        self.arena.update()
+        self.frames_since_survey += 1
+        # often while turning through the circle that maps the arena, then
+        # now and again so balls that come into view are moved on the map
+        if self.arena.mapped:
+            interval = self.MAPPED_SURVEY_INTERVAL
         else:
+            interval = self.SURVEY_INTERVAL
+        if ((self.arena.turning or self.arena.mapped) and
+                self.frames_since_survey >= interval):
+            # the whole frame, before it's cut down to the window
+            self.survey(image)
+            self.frame_info.stage('survey')
+        window = self.tracker.predict()
+        if window is None:
+            window = 0, 0, self.image_width, self.image_height
+        x0, y0, x1, y1 = window
+        # close balls are found in a downsampled frame first, see
+        # PyramidSearch
+        blobs, biggest, blob_x, blob_y = self.search.search(
+            image[y0:y1, x0:x1]
+        )
+        self.frame_info.stage('search')
+        if biggest is not None:
+            found_x = x0 + blob_x + blobs.box_centre_x[biggest]
+            found_y = y0 + blob_y + blobs.box_centre_y[biggest]
+            self.tracker.found(
+                found_x, found_y, blobs.width[biggest], blobs.height[biggest]
+            )
+            self.search.choose(blobs.area[biggest])
+            # steer by the filtered position, the raw one jitters from
+            # frame to frame and the D term amplifies that
+            ball = [self.tracker.x, found_y, blobs.box_area[biggest]]
+            self.arena.see(
+                self.colour,
+                (self.image_centre_x - self.tracker.x) / self.image_width,
+                blobs.box_area[biggest] /
+                float(self.image_width * self.image_height)
+            )
+        else:
+            self.tracker.missed()
+            self.search.choose(None)
+            found_x = found_y = -1
             ball = None
-        pygame.mouse.set_pos(found_y, 320 - found_x)
-        if biggest_contour is not None:
-            contour_area = cv2.contourArea(biggest_contour)
-            if self.screen and contour_area > self.MIN_CONTOUR_AREA:
-                font = pygame.font.Font(None, 24)
-                label = font.render(str(contour_area), 1, (250, 250, 250))
-                self.screen.blit(label, (10, 30))
-                # skate wheel at 100mm has area = 7000,
-                # from centre of course is 180, far corner is 5
-                pygame.display.update()
+        # nothing happens here unless the screen or a recorder is
+        # watching
+        self.diagnostics.publish(
+            image=image, window=window, mask=self.search.mask, blobs=blobs,
+            index=biggest, blob_origin=(x0 + blob_x, y0 + blob_y),
+            found=(found_x, found_y)
+        )
         # Set drives or report ball status
-        if not self.found:
+        if self.DRIVING and self.tracking and not self.arena.mapped:
+            self.move(self.MAPPING_TURN, 0)
+        elif not self.found:
             self.drive_toward_ball(ball, self.colour)
         elif not self.retreated:
             self.drive_away_from_ball(ball, self.colour)
@@ -153,10 +311,11 @@ class StreamProcessor(threading.Thread):
     def drive_toward_ball(self, ball, targetcolour):
         turn = 0.0
         if ball:
+            self.misses_at_bearing = 0
             x = ball[0]
             area = ball[2]
             if area > self.MAX_AREA:
-                self.drive.move(0, 0)
+                self.move(0, 0)
                 self.found = True
                 logger.info('Close enough to %s ball, stopping' % (targetcolour))
             else:
@@ -170,18 +329,36 @@ class StreamProcessor(threading.Thread):
                     turn -= self.TURN_D *(self.last_t_error - t_error)
                     forward -= self.AREA_D * (self.last_a_error - a_error)
                 if self.DRIVING and self.tracking:
-                    self.drive.move(turn, forward)
+                    self.move(turn, forward)
                 self.last_t_error = t_error
                 self.last_a_error = a_error
                 print ('%s ball, %s' % (targetcolour, t_error))
         else:
+            bearing = self.arena.bearing(targetcolour)
+            if bearing is not None and abs(bearing) < self.arena.FIELD_OF_VIEW / 4:
+                # should be in view by now, so after as many misses as
+                # the tracker allows the map's wrong
+                self.misses_at_bearing += 1
+                if self.misses_at_bearing >= BallTracker.MAX_MISSES:
+                    logger.info('No %s ball at its mapped bearing' % (targetcolour))
+                    self.arena.forget(targetcolour)
+                    self.misses_at_bearing = 0
+                    bearing = None
+            else:
+                self.misses_at_bearing = 0
+            if bearing is not None:
+                # turn straight to where the map has it
+                turn = max(-self.FAST_SEARCH_TURN,
+                           min(self.FAST_SEARCH_TURN, self.HEADING_P * bearing))
+                if self.DRIVING and self.tracking:
+                    self.move(turn, 0)
             # no ball, turn right 0.25, 0.12 ok but a bit sluggish and can get stuck in corner 0.3, -0.12 too fast, 0.3, 0 very slow. 0.25, 0.15 good
-            if self.cycle > 5:
+            elif self.cycle > 5:
                 if self.DRIVING and self.tracking:
-                    self.drive.move(self.FAST_SEARCH_TURN, 0)
+                    self.move(self.FAST_SEARCH_TURN, 0)
                 self.cycle = 0
             else:
-                self.drive.move(0, 0)
+                self.move(0, 0)
                 self.cycle += 1
             logger.info('No %s ball' % (targetcolour))
             # reset PID errors
@@ -194,7 +371,7 @@ class StreamProcessor(threading.Thread):
             x = ball[0]
             area = ball[2]
             if area < self.BACK_OFF_AREA:
-                self.drive.move(0, 0)
+                self.move(0, 0)
                 self.retreated = True
                 logger.info('far enough away from %s, stopping' % (targetcolour))
             else:
@@ -204,12 +381,12 @@ class StreamProcessor(threading.Thread):
                 if self.last_t_error is not None:
                     turn -= self.TURN_D *(self.last_t_error - t_error)
                 if self.DRIVING and self.tracking:
-                    self.drive.move(turn, forward)
+                    self.move(turn, forward)
                 self.last_t_error = t_error
         else:
             # ball lost, stop
             self.found = False
-            self.drive.move(0, 0)
+            self.move(0, 0)
             logger.info('%s ball lost' % (targetcolour))
 
 
@@ -217,15 +394,27 @@ class StreamProcessor(threading.Thread):
 class Rainbow(BaseChallenge):
     """Rainbow challenge class"""
 
-    def __init__(self, timeout=120, screen=None, joystick=None):
-        self.image_width = 320  # Camera image width
-        self.image_height = 240  # Camera image height
+    # Camera image size, and the band of it the balls appear in. Only
+    # that band is captured, to speed up processing and avoid false
+    # positives
+    ROI = RegionOfInterest((320, 240), (0, 80, 320, 100))
+    # (scale, framerate) levels the governor can step down through
+    GOVERNOR_LEVELS = ((1.0, 20), (0.75, 20), (0.5, 20), (0.5, 15))
+    # see Denoise.METHODS, and benchmark.py denoise for how they compare
+    DENOISE = 'median'
+
+    def __init__(self, timeout=120, screen=None, joystick=None,
+                 camera_service=None):
         self.frame_rate = Fraction(20)  # Camera image capture frame rate
+        self.roi = self.ROI
         self.screen = screen
         time.sleep(0.01)
         self.menu = False
         self.joystick=joystick
-        super(Rainbow, self).__init__(name='Rainbow', timeout=timeout, logger=logger)
+        super(Rainbow, self).__init__(
+            name='Rainbow', timeout=timeout, logger=logger,
+            camera_service=camera_service
+        )
 
     def setup_controls(self):
         # colours
@@ -272,23 +461,23 @@ class Rainbow(BaseChallenge):
             self.menu = not self.menu
             colour = self.processor.colour
             if not self.menu:
-                #menu closing, store values in file
-                #first, get new values
+                #menu closing, store values in file, in the background
+                profiles = self.processor.profiles
                 for ctrl in self.controls:
-                    i = ctrl['index']
-                    self.processor.colour_bounds[colour][i % 2][int(i/2)] = ctrl['ctrl'].value
-                data = self.processor.colour_bounds
-                with open('rainbow.json', 'w') as f:
-                    json.dump(data, f)
+                    profiles.set_value(colour, ctrl['index'], ctrl['ctrl'].value)
+                profiles.save()
         if button['r1']:
             self.timeout = 0
         if button['r2']:
+            # map the balls afresh from wherever the robot's been put
+            self.processor.arena.start()
             self.processor.tracking = True
-            print "Starting"
+            print("Starting")
         if button['l1']:
             self.processor.tracking = False
-            self.drive.move(0,0)
-            print "Stopping"
+            # through the processor, so the map stops turning too
+            self.processor.move(0, 0)
+            print("Stopping")
         if button['l2']:
             self.progress_colour()
             print ("manually moved on to %s" % self.processor.colour)
@@ -301,16 +490,16 @@ class Rainbow(BaseChallenge):
             self.processor.found = False
             self.processor.retreated = False
         else:
-            print "finished"
+            print("finished")
             self.timeout=0
 
     def run(self):
         # Startup sequence
         logger.info('Setup camera')
         screen = pygame.display.get_surface()
-        self.camera = picamera.PiCamera()
-        self.camera.resolution = (self.image_width, self.image_height)
-        self.camera.framerate = self.frame_rate
+        self.camera = self.lease_camera(self.roi, self.frame_rate)
+        # steps resolution and framerate down if processing can't keep up
+        self.governor = Governor(self.roi, self.GOVERNOR_LEVELS)
 
         logger.info('Setup the stream processing thread')
         # TODO: Remove dependency on drivetrain from StreamProcessor
@@ -318,13 +507,16 @@ class Rainbow(BaseChallenge):
             screen=self.screen,
             camera=self.camera,
             drive=self.drive,
-            colour="red"
+            colour="red",
+            roi=self.roi,
+            governor=self.governor,
+            denoise=self.DENOISE
         )
         # To switch target colour" on the fly, use:
         # self.processor.colour = "blue"
         self.controls = self.setup_controls()
-        logger.info('Wait ...')
-        time.sleep(2)
+        if self.screen:
+            self.processor.diagnostics.subscribe(self.processor.show)
         logger.info('Setting up image capture thread')
         self.image_capture_thread = ImageCapture(
             camera=self.camera,
@@ -341,13 +533,16 @@ class Rainbow(BaseChallenge):
                 if self.menu:
                     screen.fill([0, 0, 0])
                     colour = self.processor.colour
-                    colour_bounds = self.processor.colour_bounds[colour]
-                    #add the controls and give them their initial values
+                    profiles = self.processor.profiles
+                    #add the controls and give them their initial values,
+                    #then the vision thread follows them as they move
                     for ctrl in self.controls:
+                        i = ctrl['index']
                         if not ctrl['ctrl'].active():
-                            ctrl['ctrl'].add(ctrl['index'], fade=False)
-                            i = ctrl['index']
-                            ctrl['ctrl'].value = colour_bounds[i % 2][int(i/2)]
+                            ctrl['ctrl'].add(i, fade=False)
+                            ctrl['ctrl'].value = profiles.value(colour, i)
+                        else:
+                            profiles.set_value(colour, i, ctrl['ctrl'].value)
                 else:
                     for ctrl in self.controls:
                         if ctrl['ctrl'].active():
@@ -366,12 +561,12 @@ class Rainbow(BaseChallenge):
             self.image_capture_thread.join()
             self.processor.terminated = True
             self.processor.join()
+            self.processor.profiles.close()
+            self.log_latency()
             for ctrl in self.controls:
                 if ctrl['ctrl'].active():
                     ctrl['ctrl'].remove(fade=False)
-            #release camera
-            self.camera.close()
-            self.camera = None
+            self.release_camera()
             self.logger.info("stopping drive")
             self.drive.stop()
             pygame.mouse.set_visible(False)
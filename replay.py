@@ -0,0 +1,149 @@
+""" Replay recorded frames through a challenge's stream processor, so the
+vision code can be run and profiled without the robot
+Usage:
+  replay.py <challenge> <path> [options]
+  replay.py -h | --help
+
+Challenges: rainbow, pinoon, maze, speed
+
+<path> is a directory of images, a .bgr or .gray raw frame dump, a
+.session file recorded with --sessions or a video file. Sessions
+hold the frames as the camera delivered them, so replay them --cropped.
+
+Options:
+  -h --help             Show this screen.
+  --fps=<fps>           Frame rate to replay at [default: 30].
+  --unthrottled         Replay as fast as frames are processed, without
+                        dropping any.
+  --loop                Start again at the end of the recording.
+  --cropped             The frames are already cropped to the challenge's
+                        region of interest.
+  --resolution=<WxH>    Frame size of raw frame dumps.
+  --govern              Let the challenge's governor step resolution and
+                        framerate down if processing can't keep up. Not
+                        with --cropped.
+  --denoise=<method>    Denoise method for rainbow and pinoon, see
+                        Denoise.METHODS. The challenge's own by default.
+  --probes=<names>      Log these diagnostics probes every frame, comma
+                        separated, e.g. area,fill,mean_hsv for rainbow.
+  --debug-images=<when> Frames pinoon, maze and speed save for debugging,
+                        see debug_capture.capture_for. The challenge's own
+                        by default.
+  --sessions=<dir>      Record those frames to a session file in this
+                        directory instead of image files.
+"""
+import logging
+import logging.config
+import os
+import time
+
+from docopt import docopt
+import pygame
+import cv2.aruco as aruco
+
+from img_base_class import FrameHandoff, ImageCapture
+from frame_source import FileSource
+from governor import Governor
+from diagnostics import DiagnosticsLog
+from debug_capture import capture_for
+from motion import ReplayDrive
+import rainbow
+import pi_noon
+import marker_maze
+import straightline
+
+logging.config.fileConfig('logging.ini')
+logger = logging.getLogger('piradigm.' + __name__)
+
+SCREEN_SIZE = 240, 320
+
+
+def challenges():
+    """Stream processor, challenge class and processor arguments for
+    each challenge that can be replayed"""
+    markers = aruco.Dictionary_create(6, 3)
+    return {
+        'rainbow': (rainbow.StreamProcessor, rainbow.Rainbow, {'colour': 'red'}),
+        'pinoon': (pi_noon.StreamProcessor, pi_noon.PiNoon, {}),
+        'maze': (marker_maze.StreamProcessor, marker_maze.Maze, {'dict': markers}),
+        'speed': (straightline.StreamProcessor, straightline.StraightLineSpeed, {'dict': markers}),
+    }
+
+
+def replay(name, path, fps=30, unthrottled=False, loop=False, cropped=False,
+           resolution=None, govern=False, probes=None, denoise=None,
+           debug_images=None, sessions=None):
+    processor_class, challenge_class, options = challenges()[name]
+    roi = challenge_class.ROI
+    source = FileSource(
+        path, resolution=resolution, framerate=fps,
+        realtime=not unthrottled, loop=loop
+    )
+    if cropped:
+        source.resolution = roi.window_resolution
+    else:
+        roi.apply(source)
+
+    if not os.environ.get('DISPLAY'):
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+
+    drive = ReplayDrive()
+    if denoise:
+        options['denoise'] = denoise
+    elif hasattr(challenge_class, 'DENOISE'):
+        options['denoise'] = challenge_class.DENOISE
+    debug = None
+    if hasattr(challenge_class, 'DEBUG_IMAGES'):
+        debug = capture_for(
+            debug_images or challenge_class.DEBUG_IMAGES,
+            sessions=sessions, name=name
+        )
+        options['capture'] = debug
+    if govern:
+        options['governor'] = Governor(roi, challenge_class.GOVERNOR_LEVELS)
+    processor = processor_class(
+        screen=screen, camera=source, drive=drive, roi=roi, **options
+    )
+    processor.tracking = True
+    if probes:
+        processor.diagnostics.subscribe(DiagnosticsLog(probes))
+    if unthrottled:
+        processor.frames.handoff.policy = FrameHandoff.BLOCK
+    start_time = time.time()
+    capture = ImageCapture(camera=source, processor=processor)
+    capture.join()
+    elapsed = time.time() - start_time
+    handoff = processor.frames.handoff
+    logger.info(
+        '%s: %d frames processed in %.2f s (%.1f fps), %d motor commands',
+        name, handoff.taken, elapsed, handoff.taken / elapsed, drive.moves
+    )
+    processor.latency.log(name)
+    if debug is not None:
+        debug.close()
+        debug.log_stats()
+    return processor
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    resolution = None
+    if arguments['--resolution']:
+        resolution = tuple(int(n) for n in arguments['--resolution'].split('x'))
+    replay(
+        arguments['<challenge>'],
+        arguments['<path>'],
+        fps=float(arguments['--fps']),
+        unthrottled=arguments['--unthrottled'],
+        loop=arguments['--loop'],
+        cropped=arguments['--cropped'],
+        resolution=resolution,
+        govern=arguments['--govern'],
+        probes=arguments['--probes'] and arguments['--probes'].split(','),
+        denoise=arguments['--denoise'],
+        debug_images=arguments['--debug-images'],
+        sessions=arguments['--sessions'],
+    )
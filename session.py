@@ -0,0 +1,211 @@
+# A run's frames and what was decided on each, recorded into one file of
+# chunks rather than a loose image file per frame, and read back through
+# a memory map so any frame can be looked at or replayed without reading
+# the rest
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import numpy
+
+from debug_capture import DebugCapture
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+MAGIC = b'PIRSESS1'
+END_MAGIC = b'PIRSEND1'
+# tag, payload length
+CHUNK = struct.Struct('<4sI')
+FRAME_TAG = b'FRME'
+INDEX_TAG = b'INDX'
+# frame number, time, height, width, channels, compressed, record length
+FRAME = struct.Struct('<IdHHBBI')
+# offset of the index chunk, end magic
+TRAILER = struct.Struct('<Q8s')
+
+
+def session_path(directory, name):
+    """A new session file in directory, named after name and the time"""
+    return os.path.join(
+        directory, '%s-%s.session' % (name, time.strftime('%Y%m%d-%H%M%S'))
+    )
+
+
+def _json_default(value):
+    # numpy scalars, which is what most measurements are
+    if isinstance(value, numpy.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class SessionRecorder(DebugCapture):
+    """DebugCapture that appends frames to a session file.
+
+    Each frame is a chunk holding its record, as JSON, and the image,
+    raw or, if `compress` is set, zlib compressed. Compressing takes the
+    writer thread many times as long as writing raw, so frames are more
+    likely to be dropped at a high framerate. The record
+    gets the frame number and the time it was put() in as 'frame' and
+    'time'; the name put() is given is kept as 'name'. Compressing and
+    writing are done on the writer thread, so the stream processor only
+    pays for copying the image.
+
+    close() writes an index of where each frame chunk starts and a
+    trailer pointing at it. A session that was never closed can still be
+    read, Session finds the chunks itself."""
+
+    def __init__(self, path, compress=False, **options):
+        self.path = path
+        self.compress = compress
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offsets = []
+        super(SessionRecorder, self).__init__(**options)
+        logger.info('recording session to %s', path)
+
+    def put(self, name, image, record=None):
+        record = dict(record or {}, name=name, frame=self.frames,
+                      time=time.time())
+        return super(SessionRecorder, self).put(name, image, record)
+
+    def close(self):
+        super(SessionRecorder, self).close()
+        index = numpy.array(self._offsets, dtype='<u8')
+        offset = self._file.tell()
+        self._file.write(CHUNK.pack(INDEX_TAG, index.nbytes))
+        self._file.write(index.tobytes())
+        self._file.write(TRAILER.pack(offset, END_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        logger.info('%s: %d frames', self.path, len(self._offsets))
+
+    def _save(self, name, image, record):
+        data = numpy.ascontiguousarray(image).tobytes()
+        if self.compress:
+            data = zlib.compress(data, 1)
+        encoded = json.dumps(record, default=_json_default).encode('utf-8')
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        header = FRAME.pack(
+            record['frame'], record['time'], height, width, channels,
+            self.compress, len(encoded)
+        )
+        self._offsets.append(self._file.tell())
+        self._file.write(CHUNK.pack(
+            FRAME_TAG, len(header) + len(encoded) + len(data)
+        ))
+        self._file.write(header)
+        self._file.write(encoded)
+        self._file.write(data)
+        # so a crash loses at most the frame being written
+        self._file.flush()
+        return True
+
+
+class Session(object):
+    """A session file, memory mapped.
+
+    len() is the number of frames. frame(n) is the nth frame's image: a
+    read only view of the map for raw frames, so only good until the
+    session is closed, and decompressed for compressed ones. record(n) is
+    its record and time(n) when it was recorded. Iterating gives
+    (record, image) pairs in order."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise IOError('%s is not a session file' % path)
+        self._offsets = self._read_index()
+        if self._offsets is None:
+            logger.warning('%s was not closed, finding its frames', path)
+            self._offsets = self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.record(n), self.frame(n)
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # raw frames from it are still in use, it's closed when
+            # they've gone
+            pass
+        self._file.close()
+
+    def _read_index(self):
+        if len(self._map) < len(MAGIC) + TRAILER.size:
+            return None
+        offset, end = TRAILER.unpack_from(
+            self._map, len(self._map) - TRAILER.size
+        )
+        if end != END_MAGIC:
+            return None
+        tag, length = CHUNK.unpack_from(self._map, offset)
+        if tag != INDEX_TAG:
+            return None
+        # copied, so the map can be closed
+        return numpy.frombuffer(
+            self._map, dtype='<u8', count=length // 8,
+            offset=offset + CHUNK.size
+        ).copy()
+
+    def _scan(self):
+        """Offsets of the frame chunks, up to the first that's cut short"""
+        offsets = []
+        offset = len(MAGIC)
+        while offset + CHUNK.size <= len(self._map):
+            tag, length = CHUNK.unpack_from(self._map, offset)
+            if offset + CHUNK.size + length > len(self._map):
+                break
+            if tag == FRAME_TAG:
+                offsets.append(offset)
+            offset += CHUNK.size + length
+        return offsets
+
+    def _header(self, n):
+        """The nth frame's header, and where its record starts and its
+        chunk ends"""
+        offset = int(self._offsets[n])
+        _, length = CHUNK.unpack_from(self._map, offset)
+        start = offset + CHUNK.size
+        header = FRAME.unpack_from(self._map, start)
+        return header, start + FRAME.size, start + length
+
+    def time(self, n):
+        return self._header(n)[0][1]
+
+    def record(self, n):
+        header, start, _ = self._header(n)
+        return json.loads(
+            self._map[start:start + header[6]].decode('utf-8')
+        )
+
+    def frame(self, n):
+        header, start, end = self._header(n)
+        _, _, height, width, channels, compressed, record_length = header
+        start += record_length
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        if compressed:
+            data = zlib.decompress(self._map[start:end])
+            return numpy.frombuffer(data, dtype=numpy.uint8).reshape(shape)
+        return numpy.frombuffer(
+            self._map, dtype=numpy.uint8, count=end - start, offset=start
+        ).reshape(shape)
@@ -9,6 +9,7 @@ from pygame.locals import*
 import picamera
 import picamera.array
 from drivetrain import DriveTrain  
+from debug_capture import DebugCapture
 import time
    
 env_vars = [
@@ -34,6 +35,8 @@ pygame.init()
 screen = pygame.display.set_mode([240, 320])
 video = picamera.array.PiRGBArray(camera)
 drive = DriveTrain(timeout=120)
+# every frame is saved, by a writer thread so it doesn't slow the loop
+capture = DebugCapture()
 
 #create small cust dictionary
 small_dict = aruco.Dictionary_create(6, 3)
@@ -103,12 +106,17 @@ try:
          img_name = str(i) + "Fimg.jpg"
         else:
          img_name = str(i) + "NFimg.jpg"
-        cv2.imwrite(img_name, gray)
+        capture.put(img_name, gray)
         i += 1
         for event in pygame.event.get():
             if event.type == KEYDOWN:
                 raise KeyboardInterrupt
-except KeyboardInterrupt,SystemExit:
+except KeyboardInterrupt:
+    # timed out, a key was pressed or CTRL+C
+    pass
+finally:
     drive.move(0,0)
+    capture.close()
+    print("%d debug images written, %d dropped" % (capture.written, capture.dropped))
     pygame.quit()
     cv2.destroyAllWindows()
@@ -0,0 +1,125 @@
+# Run with python3 -m unittest test_allocations, from this directory
+import logging
+import sys
+import unittest
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+import cv2
+import numpy
+
+from frame_timing import FrameInfo
+from motion import ReplayDrive
+
+
+class StubCamera(object):
+    """Just what a stream processor asks its camera for"""
+
+    def __init__(self, resolution, framerate=30):
+        self.resolution = resolution
+        self.framerate = framerate
+
+
+class Discard(object):
+    """Somewhere for the processor's prints to go, without the buffer a
+    file would hold them in"""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+@unittest.skipIf(tracemalloc is None, 'tracemalloc needs Python 3')
+class RainbowAllocationsTest(unittest.TestCase):
+    """Rainbow's StreamProcessor keeps nothing from frame to frame once
+    its workspace buffers have grown: tracking, surveying the arena and
+    driving, allocations made in a frame are gone by the end of it"""
+
+    FRAMES = 20
+    WARM_UP = 3  # passes through the frames before anything's measured
+    SETTLE = 3  # passes traced before measuring
+    PASSES = 3
+
+    def setUp(self):
+        import rainbow
+        roi = rainbow.Rainbow.ROI
+        self.processor = rainbow.StreamProcessor(
+            camera=StubCamera(roi.window_resolution), drive=ReplayDrive(),
+            colour='red', roi=roi, denoise=rainbow.Rainbow.DENOISE
+        )
+        # frames are handed to process_image here instead
+        self.processor.terminated = True
+        self.processor.frames.close()
+        self.processor.join()
+        self.processor.tracking = True
+        self.processor.frame_info = FrameInfo()
+        self.frames = self.synthetic_frames(roi.window_resolution)
+        # logging and the processor's prints would only get in the way
+        logging.disable(logging.INFO)
+        self.stdout = sys.stdout
+        sys.stdout = Discard()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        logging.disable(logging.NOTSET)
+
+    def synthetic_frames(self, resolution):
+        """A red ball rolling across the band, shrinking as it goes,
+        and a blue one standing still"""
+        width, height = resolution
+        frames = []
+        for n in range(self.FRAMES):
+            frame = numpy.full((height, width, 3), 60, numpy.uint8)
+            cv2.circle(frame, (60 + 8 * n, height // 2), 30 - n, (0, 0, 200), -1)
+            cv2.circle(frame, (width - 40, height // 3), 8, (200, 80, 0), -1)
+            frames.append(frame)
+        return frames
+
+    def process(self, passes):
+        for n in range(passes):
+            for index, frame in enumerate(self.frames):
+                self.processor.frame_info.reset(index)
+                self.processor.process_image(frame, None)
+
+    def assertNothingKept(self):
+        # readings go in an array, so the first isn't itself an object
+        # kept until the second
+        traced = numpy.zeros(2, numpy.int64)
+        self.process(self.WARM_UP)
+        tracemalloc.start()
+        try:
+            # memory freed that was allocated before tracing started
+            # doesn't count against what's allocated after, so what the
+            # processor holds on to is replaced first, and numpy's cache
+            # of small buffers is filled again
+            self.process(self.SETTLE)
+            traced[0] = tracemalloc.get_traced_memory()[0]
+            self.process(self.PASSES)
+            traced[1] = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        kept = int(traced[1] - traced[0])
+        self.assertEqual(kept, 0, '%d bytes kept over %d frames' % (
+            kept, self.PASSES * self.FRAMES
+        ))
+
+    def test_nothing_kept_while_mapping(self):
+        # the heading is dead reckoned from the clock, so the turn that
+        # maps the arena is never allowed to finish
+        self.processor.arena.TURN_RATE = 0
+        self.assertNothingKept()
+        self.assertFalse(self.processor.arena.mapped)
+
+    def test_nothing_kept_once_mapped(self):
+        self.processor.arena.swept = 360.0
+        self.assertNothingKept()
+
+
+if __name__ == '__main__':
+    unittest.main()
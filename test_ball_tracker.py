@@ -0,0 +1,53 @@
+# Run with python -m unittest test_ball_tracker
+import unittest
+
+from ball_tracker import BallTracker
+
+
+class MissesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = BallTracker((320, 240))
+        self.tracker.found(160, 120, 10, 10)
+
+    def miss(self, times):
+        for n in range(times):
+            self.tracker.predict()
+            self.tracker.missed()
+
+    def test_kept_until_max_misses(self):
+        self.miss(BallTracker.MAX_MISSES - 1)
+        self.assertTrue(self.tracker.tracking)
+        self.assertEqual(self.tracker.misses, BallTracker.MAX_MISSES - 1)
+
+    def test_dropped_on_max_misses(self):
+        self.miss(BallTracker.MAX_MISSES)
+        self.assertFalse(self.tracker.tracking)
+        self.assertIsNone(self.tracker.predict())
+
+    def test_found_clears_misses(self):
+        self.miss(BallTracker.MAX_MISSES - 1)
+        self.tracker.predict()
+        self.tracker.found(162, 121, 10, 10)
+        self.miss(BallTracker.MAX_MISSES - 1)
+        self.assertTrue(self.tracker.tracking)
+
+    def test_reacquired_track_starts_afresh(self):
+        # a moving ball, lost and found again
+        for x in range(165, 215, 5):
+            self.tracker.predict()
+            self.tracker.found(x, 120, 10, 10)
+        self.miss(BallTracker.MAX_MISSES)
+        self.tracker.found(20, 20, 10, 10)
+        self.assertEqual(
+            self.tracker.kalman.statePost.ravel().tolist(), [20, 20, 0, 0]
+        )
+        self.assertEqual(
+            self.tracker.kalman.errorCovPost.diagonal().tolist(),
+            [BallTracker.MEASUREMENT_NOISE ** 2] * 2 +
+            [BallTracker.INITIAL_SPEED ** 2] * 2
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# HSV thresholds per colour, kept as ready to use numpy bounds and saved
+# in the background, so tuning them from the menu holds up neither the
+# UI nor the vision thread
+import json
+import logging
+import os
+import threading
+
+import numpy
+
+logger = logging.getLogger('piradigm.' + __name__)
+
+
+def compile_bounds(lower, upper):
+    """Read only uint8 arrays of a pair of HSV bounds, ready for inRange"""
+    bounds = []
+    for bound in (lower, upper):
+        bound = numpy.array(bound, dtype=numpy.uint8)
+        bound.flags.writeable = False
+        bounds.append(bound)
+    return tuple(bounds)
+
+
+class ThresholdProfiles(object):
+    """The (lower, upper) HSV bounds of each colour in a JSON file such
+    as rainbow.json.
+
+    Bounds are compiled once by compile_bounds() and never changed in
+    place: set() builds a new dict of them and swaps it in with a single
+    assignment, so a reader on another thread sees either the old bounds
+    or the new, never half of each. `version` goes up with every change,
+    for readers that build something from the bounds to know when to do
+    it again.
+
+    save() hands the current bounds to a writer thread and returns
+    straight away. The file is written alongside and renamed over the
+    old one, so it's never left half written, and saves made while one
+    is in progress are merged into one. close() waits for the last."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            data = json.load(f)
+        self._profiles = dict(
+            (name, compile_bounds(lower, upper))
+            for name, (lower, upper) in data.items()
+        )
+        self.version = 0
+        self._pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def __contains__(self, name):
+        return name in self._profiles
+
+    def __getitem__(self, name):
+        return self._profiles[name]
+
+    def get(self, name, default=None):
+        return self._profiles.get(name, default)
+
+    def bounds(self):
+        """All the bounds, as a dict that won't change"""
+        return self._profiles
+
+    def set(self, name, lower, upper):
+        profiles = dict(self._profiles)
+        profiles[name] = compile_bounds(lower, upper)
+        self._profiles = profiles
+        self.version += 1
+
+    def value(self, name, index):
+        """One bound of one channel, numbered as the menu sliders are:
+        lower and upper hue, then saturation, then value"""
+        return int(self._profiles[name][index % 2][index // 2])
+
+    def set_value(self, name, index, value):
+        """Change one bound, numbered as value() does, if it's changed"""
+        if value == self.value(name, index):
+            return
+        lower, upper = [list(bound) for bound in self._profiles[name]]
+        (lower, upper)[index % 2][index // 2] = value
+        self.set(name, lower, upper)
+
+    def as_json(self):
+        return dict(
+            (name, [bound.tolist() for bound in bounds])
+            for name, bounds in self._profiles.items()
+        )
+
+    def save(self):
+        with self._condition:
+            self._pending = self.as_json()
+            self._condition.notify()
+
+    def close(self):
+        """Finish any save in progress and stop the writer"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                data, self._pending = self._pending, None
+            if data is None:
+                return
+            try:
+                self._write(data)
+            except (IOError, OSError) as e:
+                logger.error('could not save %s: %s', self.path, e)
+
+    def _write(self, data):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.path)
+        logger.info('saved %s', self.path)
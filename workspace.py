@@ -0,0 +1,39 @@
+# Scratch buffers that last from frame to frame, so the vision code can
+# give OpenCV and numpy somewhere to write instead of allocating new
+# arrays for every stage of every frame
+import numpy
+
+
+class Workspace(object):
+    """Named buffers, handed out by shape.
+
+    Each name has one flat buffer, and buffer() returns a contiguous
+    view of the start of it in the shape asked for. It's only replaced
+    when a bigger shape or a different dtype is asked for, so windows
+    that change size from frame to frame still reuse it. Whatever is in
+    a buffer is only good until it's next asked for, by any shape.
+
+    `surfaces` is there for the pygame surfaces drawn from the buffers,
+    see mirrored_surface() in img_base_class."""
+
+    def __init__(self):
+        self._buffers = {}
+        self.surfaces = {}
+
+    def buffer(self, name, shape, dtype=numpy.uint8):
+        size = 1
+        for length in shape:
+            size *= length
+        flat = self._buffers.get(name)
+        if flat is None or flat.size < size or flat.dtype != dtype:
+            flat = self._buffers[name] = numpy.empty(size, dtype=dtype)
+        return flat[:size].reshape(shape)
+
+    def like(self, name, image):
+        """A buffer the shape and dtype of image"""
+        return self.buffer(name, image.shape, image.dtype)
+
+    def clear(self):
+        """Let everything go, e.g. when the resolution changes"""
+        self._buffers = {}
+        self.surfaces = {}